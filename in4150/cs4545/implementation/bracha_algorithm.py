@@ -1,71 +1,137 @@
-import json
 import math
-from typing import Tuple, Set, Dict
+from typing import Dict, List, Union
 from cs4545.system.da_types import *
-from cs4545.implementation.dolev_algorithm import DolevAlgorithm, DolevMessage
+from cs4545.implementation.dolev_algorithm import DolevAlgorithm, DolevMessage, popcount
 import os
 from collections import defaultdict
 import random
+import msgpack
+
+# Tag byte in front of every Bracha payload carried by the Dolev layer
+BRACHA_PAYLOAD = b'B'
+# Tag byte in front of a batch of Bracha messages, packed back to back, carried by one Dolev broadcast
+BRACHA_BATCH_PAYLOAD = b'b'
+
+# Wire encoding of BrachaMessage.msg_type (and the reverse lookup by index)
+MSG_TYPE_IDS = {"SEND": 0, "ECHO": 1, "READY": 2}
+MSG_TYPES = ("SEND", "ECHO", "READY")
+
+# Content prefix of the messages forged by colluding Byzantine nodes (see _attempt_bracha_forgery)
+FORGED_PREFIX = "FORGED-"
+
+
+def content_text(content: Union[str, bytes]) -> str:
+    """Content of a Bracha message for the logs (bytes content, e.g. from the RCO layer, is decoded)"""
+    return content.decode(errors='replace') if isinstance(content, bytes) else content
+
 
-@dataclass(msg_id=5)
 class BrachaMessage:
-    """Bracha layer message - for reliable broadcast protocol"""
-    sender_id: int
-    content: str
-    msg_type: str  # "SEND", "ECHO", or "READY"
+    """
+    Bracha layer message - for reliable broadcast protocol
 
-    def __init__(self, sender_id: int, content: str, msg_type: str):
+    Only ever sent inside a Dolev message (see to_bytes), so it is a plain slotted class instead
+    of an ipv8 payload: no per-instance __dict__ for the many messages decoded from batches.
+    """
+    __slots__ = ('sender_id', 'content', 'msg_type')
+
+    def __init__(self, sender_id: int, content: Union[str, bytes], msg_type: str):
         self.sender_id = sender_id
         self.content = content
-        self.msg_type = msg_type
+        self.msg_type = msg_type  # "SEND", "ECHO", or "READY"
 
-    @property
-    def key(self):
-        return (self.sender_id, self.content)
+    def to_frame(self) -> bytes:
+        """Serialize without tag byte, packed as (sender_id, msg_type, content)"""
+        return msgpack.packb((self.sender_id, MSG_TYPE_IDS[self.msg_type], self.content), use_bin_type=True)
 
-    def to_json(self) -> str:
+    def to_bytes(self) -> bytes:
         """Serialize for passing to Dolev layer"""
-        return json.dumps({
-            'content': self.content,
-            'msg_type': self.msg_type,
-            'sender_id': self.sender_id
-        })
+        return BRACHA_PAYLOAD + self.to_frame()
 
     @staticmethod
-    def from_json(json_str: str) -> 'BrachaMessage':
+    def from_bytes(data: bytes) -> 'BrachaMessage':
         """Deserialize from Dolev layer"""
-        obj = json.loads(json_str)
+        sender_id, msg_type, content = msgpack.unpackb(data[len(BRACHA_PAYLOAD):])
         return BrachaMessage(
-            sender_id=obj['sender_id'],
-            content=obj['content'],
-            msg_type=obj['msg_type']
+            sender_id=sender_id,
+            content=content,
+            msg_type=MSG_TYPES[msg_type]
         )
 
+    @staticmethod
+    def from_batch(data: bytes) -> List['BrachaMessage']:
+        """Deserialize a batch of frames from Dolev layer"""
+        unpacker = msgpack.Unpacker()
+        unpacker.feed(data[len(BRACHA_BATCH_PAYLOAD):])
+        return [
+            BrachaMessage(sender_id=sender_id, content=content, msg_type=MSG_TYPES[msg_type])
+            for sender_id, msg_type, content in unpacker
+        ]
+
 
 class BrachaAlgorithm(DolevAlgorithm):
+    # Bracha state flags, stored in the same per-key flags as the Dolev layer
+    F_SENT_ECHO = 1
+    F_SENT_READY = 2
+    F_DELIVERED_BRACHA = 4
+
     def __init__(self, settings: CommunitySettings) -> None:
         super().__init__(settings)
-                
+
+        self._log_bracha = self.debug_mode >= 1 and self.debug_algorithm in ('all', 'bracha')
+        self._trace_bracha = self.debug_mode >= 2 and self.debug_algorithm in ('all', 'bracha')
+
         # Optimization flags
         self.opt_echo_amplification = os.getenv('OPT_ECHO_AMPLIFICATION', 'false').lower() == 'true'
         self.opt_single_hop_send = os.getenv('OPT_SINGLE_HOP_SEND', 'false').lower() == 'true'
         self.opt_reduced_messages = os.getenv('OPT_REDUCED_MESSAGES', 'false').lower() == 'true'
 
-        # Bracha state per message (using message.key)
-        # Track if we sent ECHO for each message
-        self.sent_echo: Dict[Tuple[int, str], bool] = {}
+        # Bracha state per message (using the message key id, see DolevAlgorithm._key_id)
+        # Whether we sent ECHO, sent READY and delivered each message are tracked
+        # as F_SENT_ECHO, F_SENT_READY and F_DELIVERED_BRACHA flags (see DolevAlgorithm._flags)
+
+        # Track ECHOs received per message: msg_key -> bitmask of node_ids
+        self.echos: Dict[int, int] = defaultdict(int)
+
+        # Track READYs received per message: msg_key -> bitmask of node_ids
+        self.readys: Dict[int, int] = defaultdict(int)
+
+        # Thresholds, constant for the lifetime of the process
+        # ECHOs needed to send READY, ECHOs/READYs needed to amplify, READYs needed to deliver
+        self.echo_threshold = math.ceil((self.num_nodes + self.f + 1) / 2)
+        self.ready_amp_threshold = self.f + 1
+        self.deliver_threshold = 2 * self.f + 1
 
-        # Track if we sent READY for each message
-        self.sent_ready: Dict[Tuple[int, str], bool] = {}
+        # MBD.11: Number of nodes after the broadcaster (modulo N) that generate ECHOs/READYs
+        self.num_echo_nodes = self.echo_threshold + self.f
+        self.num_ready_nodes = self.deliver_threshold + self.f
 
-        # Track if we delivered each message
-        self.bracha_delivered: Dict[Tuple[int, str], bool] = {}
+        # Frames of ECHO/READY messages to broadcast, coalesced into one Dolev broadcast by _flush_broadcasts
+        self._out_buf: List[bytes] = []
 
-        # Track ECHOs received per message: msg_key -> set of node_ids
-        self.echos: Dict[Tuple[int, str], Set[int]] = defaultdict(set)
+    def _serialize(self, sender_id: int, content: Union[str, bytes], msg_type: str) -> bytes:
+        """Serialize a Bracha message to a frame (each ECHO/READY is sent once, see the F_SENT_* flags)"""
+        return BrachaMessage(sender_id=sender_id, content=content, msg_type=msg_type).to_frame()
 
-        # Track READYs received per message: msg_key -> set of node_ids
-        self.readys: Dict[Tuple[int, str], Set[int]] = defaultdict(set)
+    def _evict_state(self, msg_key: int) -> None:
+        super()._evict_state(msg_key)
+        self.echos.pop(msg_key, None)
+        self.readys.pop(msg_key, None)
+
+    def _queue_broadcast(self, frame: bytes) -> None:
+        """Queue a serialized Bracha message, to be broadcast by the next _flush_broadcasts"""
+        self._out_buf.append(frame)
+
+    async def _flush_broadcasts(self) -> None:
+        """Broadcast all queued Bracha messages, batched into a single Dolev broadcast if there are several"""
+        if not self._out_buf:
+            return
+
+        # Take the buffer before broadcasting, as local delivery may queue (and flush) new messages
+        frames, self._out_buf = self._out_buf, []
+        if len(frames) == 1:
+            await self.rc_broadcast(BRACHA_PAYLOAD + frames[0])
+        else:
+            await self.rc_broadcast(BRACHA_BATCH_PAYLOAD + b"".join(frames))
 
     def _should_generate_echo(self, broadcaster_id: int) -> bool:
         """
@@ -76,15 +142,9 @@ class BrachaAlgorithm(DolevAlgorithm):
         if not self.opt_reduced_messages:
             return True
 
-        num_echo_nodes = math.ceil((self.num_nodes + self.f + 1) / 2) + self.f
-
-        # Get node IDs in circular order starting after broadcaster
-        nodes_after = [(broadcaster_id + i) % self.num_nodes for i in range(1, self.num_nodes + 1)]
-
-        # First num_echo_nodes in this circular order should generate ECHOs
-        echo_nodes = set(nodes_after[:num_echo_nodes])
-
-        return self.node_id in echo_nodes
+        # Rank of this node in circular order after the broadcaster (0 for the next node)
+        rank = (self.node_id - broadcaster_id - 1) % self.num_nodes
+        return rank < self.num_echo_nodes
 
     def _should_generate_ready(self, broadcaster_id: int) -> bool:
         """
@@ -95,15 +155,8 @@ class BrachaAlgorithm(DolevAlgorithm):
         if not self.opt_reduced_messages:
             return True
 
-        num_ready_nodes = 2 * self.f + 1 + self.f
-
-        # Get node IDs in circular order starting after broadcaster
-        nodes_after = [(broadcaster_id + i) % self.num_nodes for i in range(1, self.num_nodes + 1)]
-
-        # First num_ready_nodes in this circular order should generate READYs
-        ready_nodes = set(nodes_after[:num_ready_nodes])
-
-        return self.node_id in ready_nodes
+        rank = (self.node_id - broadcaster_id - 1) % self.num_nodes
+        return rank < self.num_ready_nodes
 
     async def on_start(self) -> None:
         """Override to broadcast using Bracha instead of raw Dolev"""
@@ -118,7 +171,7 @@ class BrachaAlgorithm(DolevAlgorithm):
             message_content = f"Message-{i}"
             await self.brb_broadcast(message_content)
 
-    async def brb_broadcast(self, content: str) -> None:
+    async def brb_broadcast(self, content: Union[str, bytes]) -> None:
         """
         Bracha Broadcast
 
@@ -132,30 +185,31 @@ class BrachaAlgorithm(DolevAlgorithm):
             msg_type="SEND"
         )
 
-        if self.debug_mode >= 1 and self.debug_algorithm in ['all', 'bracha']:
-            print(f"[BRB-BROADCAST] Node {self.node_id}: Broadcasting '{content}'")
+        if self._log_bracha:
+            print(f"[BRB-BROADCAST] Node {self.node_id}: Broadcasting '{content_text(content)}'")
 
         # Byzantine behavior: limited_broadcast
         if self.byzantine_behavior == 'limited_broadcast':
             # Only send to limited number of neighbors (not all)
-            all_peers = self.get_peers()
+            all_peers = self._neighbor_peers()
             limited_peers = random.sample(all_peers, min(self.limited_neighbors, len(all_peers)))
 
-            if self.debug_mode >= 1 and self.debug_algorithm in ['all', 'bracha']:
+            if self._log_bracha:
                 print(f"[BYZANTINE-LIMITED] Node {self.node_id}: Broadcasting to only {len(limited_peers)} neighbors")
 
             # Manually send Dolev message with empty path to limited peers only
             dolev_msg = DolevMessage(
                 sender_id=self.node_id,
-                content=bracha_msg.to_json(),
+                content=bracha_msg.to_bytes(),
                 path=tuple()
             )
             await self._send_message_to_peers(dolev_msg, limited_peers)
 
             # Still deliver locally (BRB-Validity requires broadcaster delivers)
-            msg_key = bracha_msg.key
-            self.delivered[msg_key] = True
+            msg_key = self._key_id(bracha_msg.sender_id, bracha_msg.content)
+            self._set_flag(msg_key, self.F_DELIVERED_DOLEV)
             await self._handle_send(bracha_msg)
+            await self._flush_broadcasts()
             return
 
         # Optimization: Single-hop Send messages
@@ -163,34 +217,44 @@ class BrachaAlgorithm(DolevAlgorithm):
             # Send SEND only to direct neighbors (don't use rc_broadcast which would relay)
             dolev_msg = DolevMessage(
                 sender_id=self.node_id,
-                content=bracha_msg.to_json(),
+                content=bracha_msg.to_bytes(),
                 path=tuple()
             )
-            await self._send_message_to_peers(dolev_msg, self.get_peers())
+            await self._send_message_to_peers(dolev_msg, self._neighbor_peers())
 
             # Deliver locally and immediately send ECHO
-            msg_key = bracha_msg.key
-            self.delivered[msg_key] = True
+            msg_key = self._key_id(bracha_msg.sender_id, bracha_msg.content)
+            self._set_flag(msg_key, self.F_DELIVERED_DOLEV)
             await self._handle_send(bracha_msg)
+            await self._flush_broadcasts()
         else:
             # Use Dolev's rc_broadcast to send serialized Bracha message
-            await self.rc_broadcast(bracha_msg.to_json())
+            await self.rc_broadcast(bracha_msg.to_bytes())
 
-    async def rc_deliver(self, sender_id: int, content: str) -> None:
+    async def rc_deliver(self, sender_id: int, content: bytes) -> None:
         """
         Override Dolev's rc_deliver to handle Bracha messages.
         """
-        # Deserialize Bracha message
-        try:
-            bracha_msg = BrachaMessage.from_json(content)
-        except:
+        tag = content[:1]
+        if tag == BRACHA_PAYLOAD:
+            bracha_msgs = [BrachaMessage.from_bytes(content)]
+        elif tag == BRACHA_BATCH_PAYLOAD:
+            bracha_msgs = BrachaMessage.from_batch(content)
+        else:
             # If not a Bracha message, call parent's rc_deliver
             await super().rc_deliver(sender_id, content)
             return
 
-        if self.debug_mode >= 2 and self.debug_algorithm in ['all', 'bracha']:
+        for bracha_msg in bracha_msgs:
+            await self._process_bracha_message(bracha_msg, sender_id)
+
+        # Send the ECHOs/READYs triggered by these messages together
+        await self._flush_broadcasts()
+
+    async def _process_bracha_message(self, bracha_msg: BrachaMessage, sender_id: int) -> None:
+        if self._trace_bracha:
             print(f"[BRB-RECEIVE] Node {self.node_id}: {bracha_msg.msg_type} from {sender_id} | "
-                  f"Source={bracha_msg.sender_id}, Content='{bracha_msg.content}'")
+                  f"Source={bracha_msg.sender_id}, Content='{content_text(bracha_msg.content)}'")
 
         # Byzantine behavior: collude - support forged messages from other Byzantine nodes
         if self.byzantine_behavior == 'collude':
@@ -205,60 +269,53 @@ class BrachaAlgorithm(DolevAlgorithm):
             await self._handle_ready(bracha_msg, sender_id)
 
     async def _handle_send(self, msg: BrachaMessage) -> None:
-        msg_key = msg.key
+        msg_key = self._key_id(msg.sender_id, msg.content)
 
         # Optimization MBD.11: Check if we should generate ECHO
         if not self._should_generate_echo(msg.sender_id):
-            if self.debug_mode >= 2 and self.debug_algorithm in ['all', 'bracha']:
+            if self._trace_bracha:
                 print(f"[BRB-SKIP-ECHO] Node {self.node_id}: Not designated to send ECHO")
             return
 
-        if not self.sent_echo.get(msg_key, False):
-            self.sent_echo[msg_key] = True
+        if not self._has_flag(msg_key, self.F_SENT_ECHO):
+            self._set_flag(msg_key, self.F_SENT_ECHO)
 
             # Send ECHO to all nodes
-            echo_msg = BrachaMessage(
-                sender_id=msg.sender_id,
-                content=msg.content,
-                msg_type="ECHO"
-            )
+            if self._trace_bracha:
+                print(f"[BRB-SEND-ECHO] Node {self.node_id}: Sending ECHO for '{content_text(msg.content)}'")
 
-            if self.debug_mode >= 2 and self.debug_algorithm in ['all', 'bracha']:
-                print(f"[BRB-SEND-ECHO] Node {self.node_id}: Sending ECHO for '{msg.content}'")
-
-            await self.rc_broadcast(echo_msg.to_json())
+            self._queue_broadcast(self._serialize(msg.sender_id, msg.content, "ECHO"))
 
     async def _handle_echo(self, msg: BrachaMessage, sender_id: int) -> None:
         """
         Collect ECHOs. Upon ⌈(N+f+1)/2⌉ ECHOs (and not sentReady), send READY to all.
         """
-        msg_key = msg.key
+        msg_key = self._key_id(msg.sender_id, msg.content)
+
+        # Already delivered: we sent READY if designated to, so nothing is left to do (and no state to grow)
+        if self._has_flag(msg_key, self.F_DELIVERED_BRACHA):
+            return
 
         # Record the ECHO from sender_id
-        self.echos[msg_key].add(sender_id)
+        self.echos[msg_key] |= 1 << sender_id
 
-        echo_threshold = math.ceil((self.num_nodes + self.f + 1) / 2)
+        num_echos = popcount(self.echos[msg_key])
 
-        if self.debug_mode >= 2 and self.debug_algorithm in ['all', 'bracha']:
-            print(f"[BRB-ECHO-COUNT] Node {self.node_id}: {len(self.echos[msg_key])}/{echo_threshold} ECHOs")
+        if self._trace_bracha:
+            print(f"[BRB-ECHO-COUNT] Node {self.node_id}: {num_echos}/{self.echo_threshold} ECHOs")
 
         # Optimization: Echo amplification - upon f+1 ECHOs, send our ECHO
         if self.opt_echo_amplification:
-            if len(self.echos[msg_key]) >= self.f + 1 and not self.sent_echo.get(msg_key, False):
+            if num_echos >= self.ready_amp_threshold and not self._has_flag(msg_key, self.F_SENT_ECHO):
                 # Check if we should generate ECHO (MBD.11)
                 if self._should_generate_echo(msg.sender_id):
-                    self.sent_echo[msg_key] = True
-                    echo_msg = BrachaMessage(
-                        sender_id=msg.sender_id,
-                        content=msg.content,
-                        msg_type="ECHO"
-                    )
-                    if self.debug_mode >= 2 and self.debug_algorithm in ['all', 'bracha']:
-                        print(f"[BRB-ECHO-AMPLIFY] Node {self.node_id}: Amplifying ECHO after {len(self.echos[msg_key])} ECHOs")
-                    await self.rc_broadcast(echo_msg.to_json())
+                    self._set_flag(msg_key, self.F_SENT_ECHO)
+                    if self._trace_bracha:
+                        print(f"[BRB-ECHO-AMPLIFY] Node {self.node_id}: Amplifying ECHO after {num_echos} ECHOs")
+                    self._queue_broadcast(self._serialize(msg.sender_id, msg.content, "ECHO"))
 
         # Check if we have enough ECHOs to send READY
-        if len(self.echos[msg_key]) >= echo_threshold and not self.sent_ready.get(msg_key, False):
+        if num_echos >= self.echo_threshold and not self._has_flag(msg_key, self.F_SENT_READY):
             # Check if we should generate READY (MBD.11)
             if self._should_generate_ready(msg.sender_id):
                 await self._send_ready(msg)
@@ -268,123 +325,98 @@ class BrachaAlgorithm(DolevAlgorithm):
         Collect READYs. Upon f+1 READYs (and not sentReady), send READY to all.
         Upon 2f+1 READYs (and not delivered), deliver the message.
         """
-        msg_key = msg.key
+        msg_key = self._key_id(msg.sender_id, msg.content)
+
+        # Already delivered: we sent READY if designated to, so nothing is left to do (and no state to grow)
+        if self._has_flag(msg_key, self.F_DELIVERED_BRACHA):
+            return
 
-        self.readys[msg_key].add(sender_id)
+        self.readys[msg_key] |= 1 << sender_id
+        num_readys = popcount(self.readys[msg_key])
 
-        if self.debug_mode >= 2 and self.debug_algorithm in ['all', 'bracha']:
-            print(f"[BRB-READY-COUNT] Node {self.node_id}: {len(self.readys[msg_key])} READYs")
+        if self._trace_bracha:
+            print(f"[BRB-READY-COUNT] Node {self.node_id}: {num_readys} READYs")
 
         # Optimization: Echo amplification - upon receiving READY, send ECHO or READY
         if self.opt_echo_amplification:
             # Check if we can send READY (because of f+1 threshold)
-            can_send_ready = len(self.readys[msg_key]) >= self.f + 1 and not self.sent_ready.get(msg_key, False)
+            can_send_ready = num_readys >= self.ready_amp_threshold and not self._has_flag(msg_key, self.F_SENT_READY)
 
             if can_send_ready and self._should_generate_ready(msg.sender_id):
                 # If we can send READY, send READY (and mark ECHO as sent to avoid redundant ECHO)
-                self.sent_echo[msg_key] = True
+                self._set_flag(msg_key, self.F_SENT_ECHO)
                 await self._send_ready(msg)
-            elif not self.sent_echo.get(msg_key, False) and self._should_generate_echo(msg.sender_id):
+            elif not self._has_flag(msg_key, self.F_SENT_ECHO) and self._should_generate_echo(msg.sender_id):
                 # If we can't send READY yet, but haven't sent ECHO, send ECHO
-                self.sent_echo[msg_key] = True
-                echo_msg = BrachaMessage(
-                    sender_id=msg.sender_id,
-                    content=msg.content,
-                    msg_type="ECHO"
-                )
-                if self.debug_mode >= 2 and self.debug_algorithm in ['all', 'bracha']:
+                self._set_flag(msg_key, self.F_SENT_ECHO)
+                if self._trace_bracha:
                     print(f"[BRB-ECHO-FROM-READY] Node {self.node_id}: Sending ECHO after receiving READY")
-                await self.rc_broadcast(echo_msg.to_json())
+                self._queue_broadcast(self._serialize(msg.sender_id, msg.content, "ECHO"))
         else:
             # Upon f+1 READYs, send our own READY (standard amplification)
-            if len(self.readys[msg_key]) >= self.f + 1 and not self.sent_ready.get(msg_key, False):
+            if num_readys >= self.ready_amp_threshold and not self._has_flag(msg_key, self.F_SENT_READY):
                 # Check if we should generate READY (MBD.11)
                 if self._should_generate_ready(msg.sender_id):
                     await self._send_ready(msg)
 
         # Upon 2f+1 READYs, deliver
-        if len(self.readys[msg_key]) >= 2 * self.f + 1 and not self.bracha_delivered.get(msg_key, False):
+        if num_readys >= self.deliver_threshold and not self._has_flag(msg_key, self.F_DELIVERED_BRACHA):
+            # Marked here and not in brb_deliver, which subclasses override (see RCOAlgorithm.brb_deliver)
+            self._set_flag(msg_key, self.F_DELIVERED_BRACHA)
+            self._mark_completed(msg_key)
             await self.brb_deliver(msg)
 
     async def _send_ready(self, msg: BrachaMessage) -> None:
         """Send READY message to all nodes"""
-        msg_key = msg.key
-        self.sent_ready[msg_key] = True
+        msg_key = self._key_id(msg.sender_id, msg.content)
+        self._set_flag(msg_key, self.F_SENT_READY)
 
-        ready_msg = BrachaMessage(
-            sender_id=msg.sender_id,
-            content=msg.content,
-            msg_type="READY"
-        )
-
-        if self.debug_mode >= 2 and self.debug_algorithm in ['all', 'bracha']:
-            print(f"[BRB-SEND-READY] Node {self.node_id}: Sending READY for '{msg.content}'")
+        if self._trace_bracha:
+            print(f"[BRB-SEND-READY] Node {self.node_id}: Sending READY for '{content_text(msg.content)}'")
 
-        await self.rc_broadcast(ready_msg.to_json())
+        self._queue_broadcast(self._serialize(msg.sender_id, msg.content, "READY"))
 
     async def brb_deliver(self, msg: BrachaMessage) -> None:
-        msg_key = msg.key
-        self.bracha_delivered[msg_key] = True
-
-        if self.debug_mode >= 1 and self.debug_algorithm in ['all', 'bracha']:
-            print(f"[BRB-DELIVER] Node {self.node_id}: Delivered message from {msg.sender_id}: '{msg.content}'")
+        if self._log_bracha:
+            print(f"[BRB-DELIVER] Node {self.node_id}: Delivered message from {msg.sender_id}: '{content_text(msg.content)}'")
 
     async def _attempt_bracha_forgery(self) -> None:
         """Byzantine node attempts to forge a message from a correct node"""
         victim_node = random.choice([n for n in range(self.num_nodes) if n != self.node_id])
 
-        forged_content = f"FORGED-Message-from-{victim_node}"
+        forged_content = f"{FORGED_PREFIX}Message-from-{victim_node}"
 
-        if self.debug_mode >= 1 and self.debug_algorithm in ['all', 'bracha']:
+        if self._log_bracha:
             print(f"[BYZANTINE-FORGERY] Node {self.node_id}: Attempting to forge message from node {victim_node}")
 
         # Send ECHO for forged message (Byzantine nodes collude by echoing each other's forgeries)
-        echo_msg = BrachaMessage(
-            sender_id=victim_node,
-            content=forged_content,
-            msg_type="ECHO"
-        )
-        await self.rc_broadcast(echo_msg.to_json())
+        self._queue_broadcast(self._serialize(victim_node, forged_content, "ECHO"))
 
-        if self.debug_mode >= 1 and self.debug_algorithm in ['all', 'bracha']:
+        if self._log_bracha:
             print(f"[BYZANTINE-FORGERY] Node {self.node_id}: Sending ECHO for forged message")
 
         # Also send READY to try to reach quorum
-        ready_msg = BrachaMessage(
-            sender_id=victim_node,
-            content=forged_content,
-            msg_type="READY"
-        )
-        await self.rc_broadcast(ready_msg.to_json())
+        self._queue_broadcast(self._serialize(victim_node, forged_content, "READY"))
+        await self._flush_broadcasts()
 
-        if self.debug_mode >= 1 and self.debug_algorithm in ['all', 'bracha']:
+        if self._log_bracha:
             print(f"[BYZANTINE-FORGERY] Node {self.node_id}: Sending READY for forged message")
 
     async def _support_forgeries(self, msg: BrachaMessage, sender_id: int) -> None:
         """Byzantine node supports forged messages from other Byzantine nodes"""
-        msg_key = msg.key
+        msg_key = self._key_id(msg.sender_id, msg.content)
 
-        # If this looks like a forged message (content starts with "FORGED-"), support it
-        if "FORGED-" in msg.content:
-            if self.debug_mode >= 2 and self.debug_algorithm in ['all', 'bracha']:
+        # If this looks like a forged message (content starts with FORGED_PREFIX), support it
+        if FORGED_PREFIX in content_text(msg.content):
+            if self._trace_bracha:
                 print(f"[BYZANTINE-COLLUDE] Node {self.node_id}: Supporting forged message from {msg.sender_id}")
 
             # Immediately send ECHO if we received SEND
-            if msg.msg_type == "SEND" and not self.sent_echo.get(msg_key, False):
-                self.sent_echo[msg_key] = True
-                echo_msg = BrachaMessage(
-                    sender_id=msg.sender_id,
-                    content=msg.content,
-                    msg_type="ECHO"
-                )
-                await self.rc_broadcast(echo_msg.to_json())
+            if msg.msg_type == "SEND" and not self._has_flag(msg_key, self.F_SENT_ECHO):
+                self._set_flag(msg_key, self.F_SENT_ECHO)
+                self._queue_broadcast(self._serialize(msg.sender_id, msg.content, "ECHO"))
 
             # Immediately send READY if we received ECHO or READY
-            if (msg.msg_type in ["ECHO", "READY"]) and not self.sent_ready.get(msg_key, False):
-                self.sent_ready[msg_key] = True
-                ready_msg = BrachaMessage(
-                    sender_id=msg.sender_id,
-                    content=msg.content,
-                    msg_type="READY"
-                )
-                await self.rc_broadcast(ready_msg.to_json())
\ No newline at end of file
+            if (msg.msg_type in ["ECHO", "READY"]) and not self._has_flag(msg_key, self.F_SENT_READY):
+                self._set_flag(msg_key, self.F_SENT_READY)
+                self._queue_broadcast(self._serialize(msg.sender_id, msg.content, "READY"))
\ No newline at end of file
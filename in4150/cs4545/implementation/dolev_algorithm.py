@@ -1,27 +1,47 @@
-from typing import Tuple, Set, Dict
+from typing import Tuple, Dict, List
 from cs4545.system.da_types import *
+from cs4545.system.bounded_dict import BoundedDict
 import os
+import hashlib
 import random
 import asyncio
-from collections import defaultdict
+import bisect
+import numpy as np
+from collections import defaultdict, OrderedDict
+
+# Tag byte in front of every payload broadcast by the Dolev layer itself,
+# so layers on top can tell their own payloads apart without parsing them
+DOLEV_PAYLOAD = b'D'
+
+
+def popcount(mask: int) -> int:
+    """Number of node IDs in a bitmask of node IDs"""
+    return bin(mask).count("1")
+
 
 @dataclass(msg_id=4)
 class DolevMessage:
     """Dolev layer message - for authenticated message delivery"""
     sender_id: int
-    content: str
+    content: bytes
     path: Tuple[int, ...]
 
-    def __init__(self, sender_id: int, content: str, path: Tuple[int, ...]):
+    def __init__(self, sender_id: int, content: bytes, path: Tuple[int, ...]):
         self.sender_id = sender_id
         self.content = content
         self.path = path
 
-    @property
-    def key(self):
-        return (self.sender_id, self.content)
+    @classmethod
+    def fix_unpack_path(cls, value) -> Tuple[int, ...]:
+        """Called by ipv8 on deserialization: store the path as a tuple (it is unpacked as a list)"""
+        return tuple(value)
 
 class DolevAlgorithm(DistributedAlgorithm):
+    # Per-message state flags, packed into one int per message key (see _flags).
+    # Bits 0-2 are used by the Bracha layer.
+    F_DELIVERED_DOLEV = 8
+    F_EMPTY_FWD = 16
+
     def __init__(self, settings: CommunitySettings) -> None:
         super().__init__(settings)
         self.add_message_handler(DolevMessage, self.on_message)
@@ -30,6 +50,10 @@ class DolevAlgorithm(DistributedAlgorithm):
         self.f = int(os.getenv('FAULTS', '0'))
         self.min_message_delay = float(os.getenv('MIN_MESSAGE_DELAY', '0.01'))
         self.max_message_delay = float(os.getenv('MAX_MESSAGE_DELAY', '0.1'))
+        if self.min_message_delay == 0 and self.max_message_delay == 0:
+            # No delays to simulate: send right away, without sampling delays or sleeping
+            self._send_message_to_peers = self._send_no_delay
+        self._rng = np.random.default_rng()  # Delay sampling, one draw per send to all peers
         self.num_nodes = int(os.getenv('NUM_NODES', '1'))
         self.num_messages_to_broadcast = int(os.getenv('NUM_BROADCASTS', '1'))
 
@@ -40,41 +64,135 @@ class DolevAlgorithm(DistributedAlgorithm):
         # Debug mode: 0 = no logs, 1 = only RC-DELIVER, 2 = all logs
         self.debug_mode = int(os.getenv('DEBUG_MODE', '1'))
         self.debug_algorithm = os.getenv('DEBUG_ALGORITHM', 'all')
-
-        # Dolev algorithm state (per message using message.key)
-        # Dict mapping message.key -> bool (whether message has been delivered)
-        self.delivered: Dict[Tuple[int, str], bool] = {}
-
-        # Dict mapping message.key -> set of paths (each path is a tuple of node IDs)
-        self.paths: Dict[Tuple[int, str], Set[Tuple[int, ...]]] = defaultdict(set)
+        # Precomputed log guards: _log_* for level 1 logs, _trace_* for level 2 logs
+        self._log_dolev = self.debug_mode >= 1 and self.debug_algorithm in ('all', 'dolev')
+        self._trace_dolev = self.debug_mode >= 2 and self.debug_algorithm in ('all', 'dolev')
+
+        # Message keys (sender_id, content) -> small int id, assigned on first observation.
+        # All per-message state below is keyed on this id, so the content is only hashed once per message received
+        self._keycache: Dict[Tuple[int, bytes], int] = {}
+        self._key_of_id: Dict[int, Tuple[int, bytes]] = {}
+        self._next_key_id = 0
+        # Ids of evicted messages by content digest (see _retired_key), so late copies still find their flags
+        # without the content being kept. At most RETIRED_KEY_CAPACITY are kept, the flags of older ones are dropped
+        self._retired_keys = BoundedDict(int(os.getenv('RETIRED_KEY_CAPACITY', '1000000')),
+                                         on_evict=lambda _, key_id: self._flags.pop(key_id, None))
+
+        # Dolev algorithm state (per message using the message key id)
+        # Dict mapping message key id -> F_* flags, e.g. whether message has been delivered (F_DELIVERED_DOLEV)
+        # and MD.5: whether the empty path has been forwarded after delivery (F_EMPTY_FWD)
+        self._flags: Dict[int, int] = {}
+
+        # Dict mapping message key id -> {(bitmask of intermediate nodes, last hop): path} (each path is a tuple of node IDs)
+        # Paths through the same nodes to the same last hop count the same for disjointness, so only one is kept
+        self.paths: Dict[int, Dict[Tuple[int, int], Tuple[int, ...]]] = defaultdict(dict)
+
+        # Greedy selection of node-disjoint paths, updated as paths arrive:
+        # number of selected paths and the union bitmask of their intermediate nodes
+        self._disjoint_count: Dict[int, int] = {}
+        self._disjoint_union: Dict[int, int] = {}
+        # Intermediate node masks of all stored paths as (number of intermediate nodes, mask), shortest first
+        self._masks_by_length: Dict[int, List[Tuple[int, int]]] = defaultdict(list)
 
         # Optimization state (MD.1-MD.5)
+        # Sets of node IDs are stored as bitmasks (bit n set for node n)
         # MD.3: Track which neighbors have delivered each message
-        self.neighbors_delivered: Dict[Tuple[int, str], Set[int]] = defaultdict(set)
+        self.neighbors_delivered: Dict[int, int] = defaultdict(int)
 
         # MD.4: Track neighbors that sent empty paths for each message
-        self.empty_path_senders: Dict[Tuple[int, str], Set[int]] = defaultdict(set)
-
-        # MD.5: Track if empty path has been forwarded after delivery
-        self.empty_path_forwarded: Dict[Tuple[int, str], bool] = {}
+        self.empty_path_senders: Dict[int, int] = defaultdict(int)
+
+        # Keys of completed messages in completion order, at most state_cache_size of them.
+        # The per-message state of the oldest is evicted, except its flags, which keep late copies ignored
+        self.state_cache_size = int(os.getenv('STATE_CACHE_SIZE', '10000'))
+        self._completed: OrderedDict = OrderedDict()
+
+        # Neighbor peers and bitmask of neighbor node IDs, rebuilt when the set of known nodes changes
+        self._peers_cache: List[Peer] = []
+        self._nodes_mask = 0
+        self._cached_num_nodes = -1
+
+    def _key_id(self, sender_id: int, content) -> int:
+        """Int id of the message key (sender_id, content), used as the key of all per-message state"""
+        key = (sender_id, content)
+        key_id = self._keycache.get(key)
+        if key_id is None:
+            key_id = self._retired_keys.get(self._retired_key(key))
+            if key_id is not None:
+                return key_id
+            key_id = self._keycache[key] = self._next_key_id
+            self._key_of_id[key_id] = key
+            self._next_key_id += 1
+        return key_id
+
+    @staticmethod
+    def _retired_key(key) -> Tuple[int, bool, bytes]:
+        """Key of an evicted message in _retired_keys: its sender and a digest instead of the full content"""
+        sender_id, content = key
+        is_str = isinstance(content, str)
+        return (sender_id, is_str, hashlib.blake2b(content.encode() if is_str else content, digest_size=16).digest())
+
+    def _mark_completed(self, msg_key: int) -> None:
+        """Record that no more state is needed for msg_key, evicting the oldest completed message if the cache is full"""
+        self._completed[msg_key] = None
+        if len(self._completed) > self.state_cache_size:
+            evicted_key, _ = self._completed.popitem(last=False)
+            self._evict_state(evicted_key)
+
+    def _evict_state(self, msg_key: int) -> None:
+        """Drop the per-message state of msg_key (its flags are kept, see _retired_keys)"""
+        key = self._key_of_id.pop(msg_key, None)
+        if key is not None:
+            del self._keycache[key]
+            self._retired_keys[self._retired_key(key)] = msg_key
+        self.paths.pop(msg_key, None)
+        self._disjoint_count.pop(msg_key, None)
+        self._disjoint_union.pop(msg_key, None)
+        self._masks_by_length.pop(msg_key, None)
+        self.neighbors_delivered.pop(msg_key, None)
+        self.empty_path_senders.pop(msg_key, None)
+
+    def _has_flag(self, msg_key: int, flag: int) -> bool:
+        return self._flags.get(msg_key, 0) & flag == flag
+
+    def _set_flag(self, msg_key: int, flag: int) -> None:
+        self._flags[msg_key] = self._flags.get(msg_key, 0) | flag
+
+    def _refresh_neighbors(self) -> None:
+        self._peers_cache = list(self.get_peers())
+        self._nodes_mask = self._path_mask(self.nodes)
+        self._cached_num_nodes = len(self.nodes)
+
+    def _neighbor_peers(self) -> List[Peer]:
+        """Cached self.get_peers(), the topology is static once all nodes are connected"""
+        if len(self.nodes) != self._cached_num_nodes:
+            self._refresh_neighbors()
+        return self._peers_cache
+
+    def _neighbors_mask(self) -> int:
+        """Bitmask of the node IDs of all neighbors"""
+        if len(self.nodes) != self._cached_num_nodes:
+            self._refresh_neighbors()
+        return self._nodes_mask
 
     async def on_start(self) -> None:
         await super().on_start()
-        
+        self._refresh_neighbors()
+
         for i in range(self.num_messages_to_broadcast):
             message_content = f"Message-{i}"
-            await self.rc_broadcast(message_content)
+            await self.rc_broadcast(DOLEV_PAYLOAD + message_content.encode())
         
 
-    async def rc_broadcast(self, content: str) -> None:
+    async def rc_broadcast(self, content: bytes) -> None:
         """
         Reliable Communication Broadcast
 
         Initiates a broadcast of content from this node.
         Sends message with empty path to all neighbors and delivers locally.
         """
-        if self.debug_mode >= 1 and self.debug_algorithm in ['all', 'dolev']:
-            print(f"[RC-BROADCAST] Node {self.node_id}: Broadcasting message '{content}'")
+        if self._log_dolev:
+            print(f"[RC-BROADCAST] Node {self.node_id}: Broadcasting message {content!r}")
 
         # Send to all neighbors with empty path
         msg = DolevMessage(
@@ -82,9 +200,9 @@ class DolevAlgorithm(DistributedAlgorithm):
                 content=content,
                 path=tuple()  # Empty path
             )
-        await self._send_message_to_peers(msg, self.get_peers())
+        await self._send_message_to_peers(msg, self._neighbor_peers())
 
-        self.delivered[msg.key] = True
+        self._set_flag(self._key_id(self.node_id, content), self.F_DELIVERED_DOLEV)
         await self.rc_deliver(self.node_id, content)
 
     @message_wrapper(DolevMessage)
@@ -99,12 +217,12 @@ class DolevAlgorithm(DistributedAlgorithm):
         MD.5: Stop relaying after delivery + empty path sent
         """
         sender_peer_id = self.node_id_from_peer(peer)
-        msg_key = msg.key
+        msg_key = self._key_id(msg.sender_id, msg.content)
 
         # Byzantine behavior: Handle malicious actions
         if self.byzantine_behavior == 'no_relay':
             # Byzantine node doesn't relay any messages
-            if self.debug_mode >= 1 and self.debug_algorithm in ['all', 'dolev']:
+            if self._log_dolev:
                 print(f"[BYZANTINE] Node {self.node_id}: Not relaying message from {msg.sender_id}")
             return
         
@@ -112,47 +230,48 @@ class DolevAlgorithm(DistributedAlgorithm):
             await self._attempt_forgery()
 
         # MD.5: Stop processing if already delivered and empty path forwarded
-        if self.delivered.get(msg_key, False) and self.empty_path_forwarded.get(msg_key, False):
+        if self._has_flag(msg_key, self.F_DELIVERED_DOLEV | self.F_EMPTY_FWD):
             return
 
         # Check if path is empty (direct from source or post-delivery relay)
         is_empty_path = len(msg.path) == 0
 
         # Construct the new path: received path + sender
-        new_path = tuple(msg.path) + (sender_peer_id,)
+        new_path = msg.path + (sender_peer_id,)
 
-        if self.debug_mode >= 2 and self.debug_algorithm in ['all', 'dolev']:
+        if self._trace_dolev:
             path_display = "[]" if is_empty_path else str(new_path)
             print(f"[RC-RECEIVE] Node {self.node_id}: Received from peer {sender_peer_id} | "
-                  f"Source={msg.sender_id}, Content='{msg.content}', Path={path_display}")
+                  f"Source={msg.sender_id}, Content={msg.content!r}, Path={path_display}")
 
         # MD.4: If empty path received, record sender and ignore future paths with this sender
         if is_empty_path:
-            self.empty_path_senders[msg_key].add(sender_peer_id)
-            self.neighbors_delivered[msg_key].add(sender_peer_id)
+            self.empty_path_senders[msg_key] |= 1 << sender_peer_id
+            self.neighbors_delivered[msg_key] |= 1 << sender_peer_id
 
         # MD.1: If received directly from source (path is empty), deliver immediately
-        if is_empty_path and msg.sender_id == sender_peer_id and not self.delivered.get(msg_key, False):
-            self.delivered[msg_key] = True
+        if is_empty_path and msg.sender_id == sender_peer_id and not self._has_flag(msg_key, self.F_DELIVERED_DOLEV):
+            self._set_flag(msg_key, self.F_DELIVERED_DOLEV)
             await self.rc_deliver(msg.sender_id, msg.content)
 
             # MD.2: After delivery, relay with empty path to all neighbors
             await self._relay_empty_path(msg_key, msg.sender_id, msg.content)
             return
 
+        # Intermediate nodes of the path exclude the last node (sender)
+        path_mask = self._path_mask(msg.path)
+
         # MD.4: Check if path contains any node that sent empty path - if so, ignore
-        if not is_empty_path:
-            path_nodes = set(new_path[:-1])  # Exclude the last node (sender)
-            if path_nodes & self.empty_path_senders[msg_key]:
-                return
+        if path_mask & self.empty_path_senders[msg_key]:
+            return
 
-        self.paths[msg_key].add(new_path)
+        self._add_path(msg_key, new_path, path_mask)
 
         # Check if we should deliver (if not already delivered)
-        if not self.delivered.get(msg_key, False):
+        if not self._has_flag(msg_key, self.F_DELIVERED_DOLEV):
             # Check for f+1 node-disjoint paths
             if self._has_f_plus_one_disjoint_paths(msg_key):
-                self.delivered[msg_key] = True
+                self._set_flag(msg_key, self.F_DELIVERED_DOLEV)
                 await self.rc_deliver(msg.sender_id, msg.content)
 
                 # MD.2 & MD.5: After delivery, relay with empty path to all neighbors
@@ -160,13 +279,18 @@ class DolevAlgorithm(DistributedAlgorithm):
                 return
 
         # Forward to neighbors (if not already delivered)
-        if not self.delivered.get(msg_key, False):
-            path_set = set(tuple(msg.path))
-            neighbors_to_forward = set(self.nodes.keys()) - path_set - {sender_peer_id}
-
+        if not self._has_flag(msg_key, self.F_DELIVERED_DOLEV):
             # MD.3: Only relay to neighbors that have not delivered
-            neighbors_to_forward = neighbors_to_forward - self.neighbors_delivered[msg_key]
-            peers = [self.nodes[n_id] for n_id in neighbors_to_forward]
+            delivered_mask = self.neighbors_delivered[msg_key]
+
+            # Neighbors not on the path, not the sender and not delivered
+            forward_mask = self._neighbors_mask() & ~(path_mask | 1 << sender_peer_id | delivered_mask)
+            peers = []
+            while forward_mask:
+                low_bit = forward_mask & -forward_mask
+                peers.append(self.nodes[low_bit.bit_length() - 1])
+                forward_mask ^= low_bit
+
             forward_msg = DolevMessage(
                 sender_id=msg.sender_id,
                 content=msg.content,
@@ -174,8 +298,8 @@ class DolevAlgorithm(DistributedAlgorithm):
             )
             await self._send_message_to_peers(forward_msg, peers)
 
-    async def _relay_empty_path(self, msg_key: Tuple[int, str], sender_id: int, content: str) -> None:
-        if self.empty_path_forwarded.get(msg_key, False):
+    async def _relay_empty_path(self, msg_key: int, sender_id: int, content: bytes) -> None:
+        if self._has_flag(msg_key, self.F_EMPTY_FWD):
             return  # Already forwarded empty path
 
         empty_msg = DolevMessage(
@@ -183,20 +307,24 @@ class DolevAlgorithm(DistributedAlgorithm):
                 content=content,
                 path=tuple()  # Empty path
             )
-        await self._send_message_to_peers(empty_msg, self.get_peers())
+        await self._send_message_to_peers(empty_msg, self._neighbor_peers())
 
         # MD.5: Mark empty path as forwarded
-        self.empty_path_forwarded[msg_key] = True
+        self._set_flag(msg_key, self.F_EMPTY_FWD)
 
         # Discard paths to save memory (MD.2)
         if msg_key in self.paths:
             del self.paths[msg_key]
+        self._disjoint_count.pop(msg_key, None)
+        self._disjoint_union.pop(msg_key, None)
+        self._masks_by_length.pop(msg_key, None)
+        self._mark_completed(msg_key)
 
-    async def rc_deliver(self, sender_id: int, content: str) -> None:
-        if self.debug_mode >= 1 and self.debug_algorithm in ['all', 'dolev']:
-            print(f"[RC-DELIVER] Node {self.node_id}: Delivered message from {sender_id}: '{content}'")
+    async def rc_deliver(self, sender_id: int, content: bytes) -> None:
+        if self._log_dolev:
+            print(f"[RC-DELIVER] Node {self.node_id}: Delivered message from {sender_id}: '{content[len(DOLEV_PAYLOAD):].decode(errors='replace')}'")
 
-    def _has_f_plus_one_disjoint_paths(self, msg_key: Tuple[int, str]) -> bool:
+    def _has_f_plus_one_disjoint_paths(self, msg_key: int) -> bool:
         """
         Check if we have at least f+1 node-disjoint paths
 
@@ -205,35 +333,54 @@ class DolevAlgorithm(DistributedAlgorithm):
 
         Returns True if at least f+1 node-disjoint paths exist.
         """
-        paths_list = list(self.paths[msg_key])
+        return self._disjoint_count.get(msg_key, 0) >= self.f + 1
 
-        if len(paths_list) < self.f + 1:
-            return False
+    def _add_path(self, msg_key: int, path: Tuple[int, ...], path_mask: int) -> None:
+        """
+        Store a newly received path and update the disjoint path selection
 
-        # Find maximum set of node-disjoint paths using greedy approach
-        disjoint_paths = []
+        A path is selected if it shares no intermediate nodes with the paths selected before it.
+        If it does, the selection is redone greedily over all stored paths, shortest first:
+        shorter paths block fewer nodes, so they leave more room for other disjoint paths.
+        """
+        path_key = (path_mask, path[-1])
+        if path_key in self.paths[msg_key]:
+            return
 
-        for path in paths_list:
-            is_disjoint = True
+        self.paths[msg_key][path_key] = path
+        masks_by_length = self._masks_by_length[msg_key]
+        bisect.insort(masks_by_length, (popcount(path_mask), path_mask))
 
-            # Get intermediate nodes (exclude destination which is this node)
-            path_nodes = set(path[:-1]) if len(path) > 0 else set()
+        # If paths share any intermediate nodes, they're not disjoint
+        union = self._disjoint_union.get(msg_key, 0)
+        if path_mask & union == 0:
+            self._disjoint_union[msg_key] = union | path_mask
+            self._disjoint_count[msg_key] = self._disjoint_count.get(msg_key, 0) + 1
+            return
 
-            for selected_path in disjoint_paths:
-                selected_nodes = set(selected_path[:-1]) if len(selected_path) > 0 else set()
+        if self._disjoint_count.get(msg_key, 0) >= self.f + 1:
+            return
 
-                # If paths share any intermediate nodes, they're not disjoint
-                if path_nodes & selected_nodes:
-                    is_disjoint = False
+        count, union = 0, 0
+        for _, mask in masks_by_length:
+            if mask & union == 0:
+                union |= mask
+                count += 1
+                if count >= self.f + 1:
                     break
 
-            if is_disjoint:
-                disjoint_paths.append(path)
+        # Keep whichever selection is larger, both are sets of disjoint paths
+        if count > self._disjoint_count.get(msg_key, 0):
+            self._disjoint_count[msg_key] = count
+            self._disjoint_union[msg_key] = union
 
-                if len(disjoint_paths) >= self.f + 1:
-                    return True
-
-        return False
+    @staticmethod
+    def _path_mask(nodes: Tuple[int, ...]) -> int:
+        """Bitmask with bit n set for every node n in nodes"""
+        mask = 0
+        for node in nodes:
+            mask |= 1 << node
+        return mask
 
     async def _attempt_forgery(self) -> None:
         # Pick a random node to impersonate (not ourselves)
@@ -243,23 +390,39 @@ class DolevAlgorithm(DistributedAlgorithm):
         forged_content = f"FORGED-Message-from-{victim_node}"
         forged_msg = DolevMessage(
             sender_id=victim_node,  # Claim to be from victim
-            content=forged_content,
+            content=DOLEV_PAYLOAD + forged_content.encode(),
             path=tuple()  # Empty path to appear as original broadcast
         )
 
-        if self.debug_mode >= 1 and self.debug_algorithm in ['all', 'dolev']:
+        if self._log_dolev:
             print(f"[BYZANTINE-FORGERY] Node {self.node_id}: Attempting to forge message from node {victim_node}")
 
-        await self._send_message_to_peers(forged_msg, self.get_peers())
+        await self._send_message_to_peers(forged_msg, self._neighbor_peers())
 
-    async def _send_message_to_peers(self, message: DolevMessage, peers) -> None:
-        async def send_with_delay(peer):
-            delay = random.uniform(self.min_message_delay, self.max_message_delay)
-            await asyncio.sleep(delay)
-            self.ez_send(peer, message)
+    async def _send_no_delay(self, message: DolevMessage, peers) -> None:
+        if not peers:
+            return
 
-        tasks = []
+        packet = self.ez_pack(message)
         for peer in peers:
-            tasks.append(asyncio.create_task(send_with_delay(peer)))
+            self.ez_send_packed(peer, packet, message)
+
+    async def _send_message_to_peers(self, message: DolevMessage, peers) -> None:
+        if not peers:
+            return
 
-        await asyncio.gather(*tasks)
\ No newline at end of file
+        # Sample the delays of all peers in one vectorized draw and send in order of delay from
+        # this single coroutine, sleeping only until the next send is due
+        delays = self._rng.uniform(self.min_message_delay, self.max_message_delay, len(peers)).tolist()
+        scheduled = sorted(zip(delays, peers), key=lambda item: item[0])
+
+        # The packet is identical for every peer, so serialize and sign it once
+        packet = self.ez_pack(message)
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for delay, peer in scheduled:
+            remaining = start + delay - loop.time()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+            self.ez_send_packed(peer, packet, message)
@@ -1,11 +1,18 @@
-from typing import Tuple
+from typing import Tuple, List
 from cs4545.system.da_types import *
+from cs4545.system.bounded_dict import BoundedDict, BoundedSet, state_bounds
+from cs4545.system.disjoint_paths import first_hop_insert, kept_paths, count_disjoint_paths
+from cs4545.system.send_mixins import DelayedSends, PeerSnapshot
+from cs4545.system.salted_cache import SaltedCache
 import os
+import functools
 import random
 import asyncio
 from collections import defaultdict
 import math
 
+EMPTY_FROZENSET = frozenset() # Default for set lookups, so a missing key does not build a new set
+
 @dataclass(msg_id=4)
 class DolevMessage:
     content: str
@@ -16,19 +23,40 @@ class DolevMessage:
     dolev_sender_id: int # Sender message on Dolev layer
     dolev_msg_sender_id: int # Original sender of the message on Dolev layer
     
-    @property
+    @functools.cached_property
     def bracha_key(self):
         return (self.msg_sender_id, self.content)
 
-    @property
+    @functools.cached_property
     def key(self):
         return (self.sender_id, self.content, self.msg_type)
 
+    fix_unpack_content = classmethod(intern_unpacked)  # Called by ipv8 on deserialization
+    fix_unpack_path = classmethod(tuple_unpacked)
+
+
+@dataclass(msg_id=7)
+class DolevBatch:
+    msgs: List[DolevMessage] # Messages to the same peer, sent together
+
+
+class BrachaState:
+    """Bracha progress of one broadcast, so a message needs a single lookup for all of it"""
+    __slots__ = ('sent_echo', 'sent_ready', 'delivered', 'echos', 'readys')
 
-class BrachaAlgorithm(DistributedAlgorithm):
+    def __init__(self):
+        self.sent_echo = False
+        self.sent_ready = False
+        self.delivered = False
+        self.echos = set() # node_ids the ECHO was received from
+        self.readys = set() # node_ids the READY was received from
+
+
+class BrachaAlgorithm(DelayedSends, PeerSnapshot, DistributedAlgorithm):
     def __init__(self, settings: CommunitySettings) -> None:
         super().__init__(settings)
-        self.add_message_handler(DolevMessage, self.on_ipv8_message)
+        self.add_message_handler(DolevMessage, self.on_raw_dolev_message)
+        self.add_message_handler(DolevBatch, self.on_dolev_batch)
 
         self.f = int(os.getenv('FAULTS', '0'))
         self.min_message_delay = float(os.getenv('MIN_MESSAGE_DELAY', '0.01')) # default 10ms
@@ -40,15 +68,26 @@ class BrachaAlgorithm(DistributedAlgorithm):
         self.byzantine_behavior = os.getenv('BYZANTINE_BEHAVIOR', 'none')
         self.limited_neighbors = int(os.getenv('LIMITED_NEIGHBORS', '1'))  # For limited_broadcast behavior
 
+        # Messages per peer waiting to be sent together, flushed FLUSH_INTERVAL seconds after the first one
+        self.flush_interval = float(os.getenv('FLUSH_INTERVAL', '0.005'))
+        self.pending = defaultdict(list)
+
+        # Duplicate filters: raw packets (checked before decoding) and (dolev key, path) pairs.
+        # Their salts rotate every DEDUP_ROTATE_INTERVAL seconds, which also bounds their size
+        self.raw_cache = SaltedCache()
+        self.path_cache = SaltedCache()
+        dedup_rotate_interval = float(os.getenv('DEDUP_ROTATE_INTERVAL', '30'))
+        self.register_task("rotate_dedup_caches", self.rotate_dedup_caches, interval=dedup_rotate_interval, delay=dedup_rotate_interval)
 
-        self.dolev_delivered = {} # Dict mapping (message, sender_id, message_id) to node_ids that delivered it
-        self.dolev_paths = {} # Dict mapping (message, sender_id, message_id) to set of paths (tuples of node_ids)
+
+        # Per-message state is bounded by size and age (see state_bounds)
+        bounds = state_bounds()
+        self.dolev_delivered = BoundedDict(*bounds) # Dict mapping (message, sender_id, message_id) to node_ids that delivered it
+        self.dolev_paths = BoundedDict(*bounds) # Dict mapping (message, sender_id, message_id) to the received paths by first hop (see first_hop_insert)
+        self.disjoint_count = BoundedDict(*bounds) # Dict mapping a key to the number of disjoint paths in its set of paths (up to f+1)
+        self.disjoint_frozen = BoundedSet(*bounds) # Set of keys with f+1 disjoint paths, for which the count is no longer updated
         
-        self.sent_echo = set()
-        self.sent_ready = set()
-        self.bracha_delivered = set()
-        self.echos = defaultdict(set)
-        self.readys = defaultdict(set)
+        self.bracha = BoundedDict(*bounds) # Dict mapping a bracha key to its BrachaState
 
     async def on_start(self) -> None:
         print(f"[Start] Node {self.node_id} initialized with f={self.f}, message delay [{self.min_message_delay}, {self.max_message_delay}], NUM_BROADCASTS={self.num_messages_to_broadcast}, Byzantine Behavior={self.byzantine_behavior}, Nodes={self.num_nodes}")
@@ -57,14 +96,14 @@ class BrachaAlgorithm(DistributedAlgorithm):
 
         if self.num_messages_to_broadcast > 0:
             print(f"[Start] Node {self.node_id} Broadcasting {self.num_messages_to_broadcast} message(s)")
-            for msg in range(self.num_messages_to_broadcast):
-                content = f"Message {msg} from node {self.node_id}"
-
-                # Byzantine behavior: limited_broadcast
-                if self.byzantine_behavior == 'limited_broadcast':
-                    await self.do_limited_broadcast(content, self.node_id, self.node_id, "SEND")
-                else:
-                    await self.do_dolev_broadcast(content, self.node_id, self.node_id, "SEND")
+            # Byzantine behavior: limited_broadcast
+            if self.byzantine_behavior == 'limited_broadcast':
+                broadcast = self.do_limited_broadcast
+            else:
+                broadcast = self.do_dolev_broadcast
+            # Start all broadcasts together, instead of one after the other
+            await asyncio.gather(*[broadcast(f"Message {msg} from node {self.node_id}", self.node_id, self.node_id, "SEND")
+                                   for msg in range(self.num_messages_to_broadcast)])
 
         # Byzantine collude behavior: Try to forge messages from a correct node
         if self.byzantine_behavior == 'collude':
@@ -73,22 +112,27 @@ class BrachaAlgorithm(DistributedAlgorithm):
             print(f"[Byzantine-Collude] Node {self.node_id}: Attempting to forge message from node {forged_sender_id}")
             await self.do_dolev_broadcast(forged_content, forged_sender_id, forged_sender_id, "SEND")
                 
+    def send_now(self, peer: Peer, payload: DolevMessage) -> None:
+        # Messages to the same peer are sent together (see flush_peer)
+        pending = self.pending[peer]
+        pending.append(payload)
+        if len(pending) == 1:
+            self.register_anonymous_task("flush_peer", self.flush_peer, peer, delay=self.flush_interval)
+
+    def flush_peer(self, peer: Peer) -> None:
+        messages = self.pending.pop(peer, [])
+        if len(messages) == 1:
+            self.ez_send(peer, messages[0])
+        elif messages:
+            self.ez_send(peer, DolevBatch(messages))
+
     async def send_message_to_peers(self, payload: DolevMessage) -> None:
-        async def send_with_delay(peer):
-            delay = random.uniform(self.min_message_delay, self.max_message_delay)
-            await asyncio.sleep(delay)
-            self.ez_send(peer, payload)
-            
-        peers = self.get_peers()
-        tasks = []
-        for peer in peers:
-            peer_id = self.node_id_from_peer(peer)
-            if (peer_id in payload.path) \
-                or (payload.key in self.dolev_delivered and peer_id in self.dolev_delivered[payload.key]):
-                continue
-            tasks.append(asyncio.create_task(send_with_delay(peer)))
-        
-        await asyncio.gather(*tasks)
+        # Bind to locals, so the filter below does not look up attributes for every peer
+        path_set = frozenset(payload.path)
+        delivered = self.dolev_delivered.get(payload.key, EMPTY_FROZENSET)
+        targets = [peer for peer, peer_id in self.get_peers_snapshot()
+                   if peer_id not in path_set and peer_id not in delivered]
+        self.enqueue_sends(targets, payload)
 
     async def do_dolev_broadcast(self, content: str, msg_sender_id: str, sender_id: str, msg_type: str) -> None:
         payload = DolevMessage(content, msg_sender_id, msg_type, sender_id, (), self.node_id, self.node_id)
@@ -102,64 +146,89 @@ class BrachaAlgorithm(DistributedAlgorithm):
 
         print(f"[Byzantine-Limited] Node {self.node_id}: Broadcasting to only {len(limited_peers)}/{len(peers)} neighbors")
 
-        async def send_with_delay(peer):
-            delay = random.uniform(self.min_message_delay, self.max_message_delay)
-            await asyncio.sleep(delay)
-            self.ez_send(peer, payload)
-
-        tasks = [asyncio.create_task(send_with_delay(peer)) for peer in limited_peers]
-        await asyncio.gather(*tasks)
+        self.enqueue_sends(limited_peers, payload)
 
         await self.do_dolev_deliver(payload)       
 
+    def rotate_dedup_caches(self) -> None:
+        self.raw_cache.rotate()
+        self.path_cache.rotate()
+
+    def on_raw_dolev_message(self, source_address, data: bytes):
+        # Drop byte-identical retransmissions before decoding them
+        if self.raw_cache.check_and_put(data):
+            return None
+        return self.on_ipv8_message(source_address, data)
+
     @message_wrapper(DolevMessage)
     async def on_ipv8_message(self, peer: Peer, payload: DolevMessage) -> None:
+        await self.safe_dispatch(peer, (payload,))
+
+    @message_wrapper(DolevBatch)
+    async def on_dolev_batch(self, peer: Peer, batch: DolevBatch) -> None:
+        await self.safe_dispatch(peer, batch.msgs)
+
+    async def safe_dispatch(self, peer: Peer, payloads) -> None:
+        # ipv8 ignores exceptions raised by handler coroutines, so print them here, once per packet
         try:
-            sender_id = self.node_id_from_peer(peer)
+            for payload in payloads:
+                await self.process_dolev_message(peer, payload)
+        except Exception as e:
+            print(f"[Error] process_dolev_message: {e}")
+            raise e
 
-            # Authentication check
-            if sender_id != payload.dolev_sender_id:
-                return
+    async def process_dolev_message(self, peer: Peer, payload: DolevMessage) -> None:
+        sender_id = self.peer_id(peer)
 
-            # Drop if sender delivered
-            if payload.key in self.dolev_delivered and self.node_id in self.dolev_delivered[payload.key]:
-                return
+        # Authentication check
+        if sender_id != payload.dolev_sender_id:
+            return
 
-            # Sender delivered, so update delivered set for this message
-            if payload.path == ():
-                if payload.key in self.dolev_delivered:
-                    self.dolev_delivered[payload.key].add(sender_id)
-                else:
-                    self.dolev_delivered[payload.key] = set([sender_id])
+        # Drop if sender delivered
+        if payload.key in self.dolev_delivered and self.node_id in self.dolev_delivered[payload.key]:
+            return
 
-            path = tuple(payload.path) + (sender_id,)
+        # Sender delivered, so update delivered set for this message
+        if payload.path == ():
+            if payload.key in self.dolev_delivered:
+                self.dolev_delivered[payload.key].add(sender_id)
+            else:
+                self.dolev_delivered[payload.key] = set([sender_id])
 
-            nodes_that_delivered = self.dolev_delivered.get(payload.key, set())
-            path_contains_delivered_node = any(node in nodes_that_delivered for node in path)
-            if path_contains_delivered_node:
-                return
-            
-            if payload.key not in self.dolev_paths:
-                self.dolev_paths[payload.key] = set()
-            self.dolev_paths[payload.key].add(path)
-            
-            send_payload = DolevMessage(payload.content, payload.msg_sender_id, payload.msg_type, payload.sender_id, path, self.node_id, payload.dolev_msg_sender_id)
-            num_disjoint_paths = count_disjoint_paths(self.dolev_paths[payload.key]) if payload.key in self.dolev_paths else 0
-            if (num_disjoint_paths >= self.f + 1 and payload.key not in self.dolev_delivered) \
-                or (sender_id == payload.msg_sender_id and payload.path == ()):
-                await self.do_dolev_deliver(payload)
-
-                # When delivered, send with empty path
-                send_payload.path = ()
-            
-            # Optimization Single-hop Send messages:
-            # Don't forward SEND messages: since we get them from the sender directly, we immediately dolev-deliver it and send ECHO to neighbors instead
-            if payload.msg_type != "SEND":
-                await self.send_message_to_peers(send_payload)
+        path = payload.path + (sender_id,)
+
+        # Drop messages that arrived over this exact path before
+        if self.path_cache.check_and_put(repr((payload.key, path)).encode()):
+            return
+
+        # Like the disjoint path count, ignore the first node of the path: it has always delivered
+        nodes_that_delivered = self.dolev_delivered.get(payload.key, EMPTY_FROZENSET)
+        path_contains_delivered_node = not nodes_that_delivered.isdisjoint(path[1:])
+        if path_contains_delivered_node:
+            return
+        
+        if first_hop_insert(self.dolev_paths.setdefault(payload.key, {}), path):
+            # Only recount for new paths, and stop counting once there are enough.
+            # Fewer than f+1 first hops can never hold f+1 disjoint paths, so those are not counted at all
+            if payload.key not in self.disjoint_frozen and len(self.dolev_paths[payload.key]) >= self.f + 1:
+                self.disjoint_count[payload.key] = count_disjoint_paths(kept_paths(self.dolev_paths[payload.key]), limit=self.f + 1)
+                if self.disjoint_count[payload.key] >= self.f + 1:
+                    self.disjoint_frozen.add(payload.key)
+        
+        send_payload = DolevMessage(payload.content, payload.msg_sender_id, payload.msg_type, payload.sender_id, path, self.node_id, payload.dolev_msg_sender_id)
+        num_disjoint_paths = self.disjoint_count.get(payload.key, 0)
+        if (num_disjoint_paths >= self.f + 1 and self.node_id not in nodes_that_delivered) \
+            or (sender_id == payload.msg_sender_id and payload.path == ()):
+            await self.do_dolev_deliver(payload)
+
+            # When delivered, send with empty path
+            send_payload.path = ()
+        
+        # Optimization Single-hop Send messages:
+        # Don't forward SEND messages: since we get them from the sender directly, we immediately dolev-deliver it and send ECHO to neighbors instead
+        if payload.msg_type != "SEND":
+            await self.send_message_to_peers(send_payload)
 
-        except Exception as e:
-            print(f"[Error] on_ipv8_message: {e}")
-            raise e
     
     async def do_dolev_deliver(self, payload: DolevMessage) -> None:
         # Authentication on Bracha layer
@@ -170,57 +239,42 @@ class BrachaAlgorithm(DistributedAlgorithm):
         self.dolev_delivered[payload.key] = set([self.node_id])
         
         distance_from_source = (self.node_id - payload.msg_sender_id) % self.num_nodes
+        state = self.bracha.get(payload.bracha_key)
+        if state is None:
+            state = self.bracha[payload.bracha_key] = BrachaState()
 
         if payload.msg_type in ["SEND", "ECHO"]:
-            if not payload.bracha_key in self.sent_echo:
-                self.sent_echo.add(payload.bracha_key)                    
+            if not state.sent_echo:
+                state.sent_echo = True
                 # Optimization 3
                 if distance_from_source < math.ceil((self.num_nodes+self.f+1)/2) + self.f: 
                     await self.do_dolev_broadcast(payload.content, payload.msg_sender_id, self.node_id, "ECHO")
 
         if payload.msg_type == "ECHO":
-            self.echos[payload.bracha_key].add(payload.sender_id)
+            state.echos.add(payload.sender_id)
             
         elif payload.msg_type == "READY":
-            self.readys[payload.bracha_key].add(payload.sender_id)
+            state.readys.add(payload.sender_id)
         
-        if not payload.bracha_key in self.sent_ready:
-            if len(self.echos[payload.bracha_key]) >= math.ceil((self.num_nodes + self.f + 1) / 2) or \
-                len(self.readys[payload.bracha_key]) >= self.f+1:
-                self.sent_ready.add(payload.bracha_key)
+        if not state.sent_ready:
+            if len(state.echos) >= math.ceil((self.num_nodes + self.f + 1) / 2) or \
+                len(state.readys) >= self.f+1:
+                state.sent_ready = True
                 # Optimization 3
                 if distance_from_source < (2*self.f + 1 + self.f):
                     await self.do_dolev_broadcast(payload.content, payload.msg_sender_id, self.node_id, "READY")
             
-            elif not payload.bracha_key in self.sent_echo and \
-                (payload.msg_type == "READY" or len(self.echos[payload.bracha_key]) >= self.f+1):
+            elif not state.sent_echo and \
+                (payload.msg_type == "READY" or len(state.echos) >= self.f+1):
                 # optimization 1
-                self.sent_echo.add(payload.bracha_key)
+                state.sent_echo = True
                 if distance_from_source < math.ceil((self.num_nodes+self.f+1)/2) + self.f:
                     # optimization 3
                     await self.do_dolev_broadcast(payload.content, payload.msg_sender_id, self.node_id, "ECHO")
                 
-        if not payload.bracha_key in self.bracha_delivered and len(self.readys[payload.bracha_key]) >= 2*self.f+1:
-            self.do_bracha_deliver(payload)
+        if not state.delivered and len(state.readys) >= 2*self.f+1:
+            self.do_bracha_deliver(payload, state)
 
-    def do_bracha_deliver(self, payload: DolevMessage) -> None:
-        self.bracha_delivered.add(payload.bracha_key)
+    def do_bracha_deliver(self, payload: DolevMessage, state: BrachaState) -> None:
+        state.delivered = True
         print(f"[Bracha] Node {self.node_id}: Message is delivered from sender {payload.sender_id} [{payload.msg_sender_id}: \"{payload.content}\"]")
-
-
-def count_disjoint_paths(paths):
-    sets = [set(s[1:]) for s in paths]
-    n = len(sets)
-    best = 0
-
-    def backtrack(i, chosen, used):
-        nonlocal best
-        if i == n:
-            best = max(best, len(chosen))
-            return
-        backtrack(i + 1, chosen, used)
-        if sets[i].isdisjoint(used):
-            backtrack(i + 1, chosen + [i], used | sets[i])
-
-    backtrack(0, [], set())
-    return best
\ No newline at end of file
@@ -1,11 +1,18 @@
 from typing import Tuple, Literal, List
 from cs4545.system.da_types import *
+from cs4545.system.bounded_dict import BoundedDict, BoundedSet, state_bounds
+from cs4545.system.disjoint_paths import first_hop_insert, kept_paths, count_disjoint_paths
+from cs4545.system.send_mixins import DelayedSends, PeerSnapshot
+from cs4545.system.salted_cache import SaltedCache
 import os
+import functools
 import random
 import asyncio
 from collections import defaultdict
 import math
 
+EMPTY_FROZENSET = frozenset() # Default for set lookups, so a missing key does not build a new set
+
 @dataclass(msg_id=4)
 class DolevMessage:
     content: str
@@ -16,22 +23,43 @@ class DolevMessage:
     path: Tuple[int]
 
     intended_targets: Tuple[int] # Only for limited broadcasts. Defines which nodes should Dolev-deliver this message
+
+    fix_unpack_content = classmethod(intern_unpacked)  # Called by ipv8 on deserialization
+    fix_unpack_path = classmethod(tuple_unpacked)
     
-    @property
+    @functools.cached_property
     def bracha_key(self):
         return (self.content, self.broadcast_sender_id)
 
-    @property
+    @functools.cached_property
     def dolev_key(self):
         return (self.content, self.broadcast_sender_id, self.msg_type, self.dolev_sender_id)
     
 
 
 
-class BrachaAlgorithm(DistributedAlgorithm):
+@dataclass(msg_id=7)
+class DolevBatch:
+    msgs: List[DolevMessage] # Messages to the same peer, sent together
+
+
+class BrachaState:
+    """Bracha progress of one broadcast, so a message needs a single lookup for all of it"""
+    __slots__ = ('sent_echo', 'sent_ready', 'delivered', 'echos', 'readys')
+
+    def __init__(self):
+        self.sent_echo = False
+        self.sent_ready = False
+        self.delivered = False
+        self.echos = set() # node_ids the ECHO was received from
+        self.readys = set() # node_ids the READY was received from
+
+
+class BrachaAlgorithm(DelayedSends, PeerSnapshot, DistributedAlgorithm):
     def __init__(self, settings: CommunitySettings) -> None:
         super().__init__(settings)
-        self.add_message_handler(DolevMessage, self.on_ipv8_message)
+        self.add_message_handler(DolevMessage, self.on_raw_dolev_message)
+        self.add_message_handler(DolevBatch, self.on_dolev_batch)
 
         self.f = int(os.getenv('FAULTS', '0'))
         self.min_message_delay = float(os.getenv('MIN_MESSAGE_DELAY', '0.01')) # default 10ms
@@ -43,16 +71,27 @@ class BrachaAlgorithm(DistributedAlgorithm):
         self.byzantine_behavior = os.getenv('BYZANTINE_BEHAVIOR', 'none')
         self.limited_neighbors = int(os.getenv('LIMITED_NEIGHBORS', '1'))  # For limited_broadcast behavior
 
-        self.delivered = set() # Set of keys (message, sender_id) that have been delivered
-        self.empty_forwarded = set() # Set of keys (message, sender_id) for which the empty path has been forwarded
-        self.who_delivered = defaultdict(set) # Dictionary mapping a key (message, sender_id) to a set of nodes that have delivered this message
-        self.paths = defaultdict(set) # Dict mapping (message, sender_id, message_id) to set of paths (tuples of node_ids)
+        # Messages per peer waiting to be sent together, flushed FLUSH_INTERVAL seconds after the first one
+        self.flush_interval = float(os.getenv('FLUSH_INTERVAL', '0.005'))
+        self.pending = defaultdict(list)
+
+        # Duplicate filters: raw packets (checked before decoding) and (dolev key, path) pairs.
+        # Their salts rotate every DEDUP_ROTATE_INTERVAL seconds, which also bounds their size
+        self.raw_cache = SaltedCache()
+        self.path_cache = SaltedCache()
+        dedup_rotate_interval = float(os.getenv('DEDUP_ROTATE_INTERVAL', '30'))
+        self.register_task("rotate_dedup_caches", self.rotate_dedup_caches, interval=dedup_rotate_interval, delay=dedup_rotate_interval)
+
+        # Per-message state is bounded by size and age (see state_bounds)
+        bounds = state_bounds()
+        self.delivered = BoundedSet(*bounds) # Set of keys (message, sender_id) that have been delivered
+        self.empty_forwarded = BoundedSet(*bounds) # Set of keys (message, sender_id) for which the empty path has been forwarded
+        self.who_delivered = BoundedDict(*bounds) # Dictionary mapping a key (message, sender_id) to a set of nodes that have delivered this message
+        self.paths = BoundedDict(*bounds) # Dict mapping (message, sender_id, message_id) to the received paths by first hop (see first_hop_insert)
+        self.disjoint_count = BoundedDict(*bounds) # Dict mapping a key to the number of disjoint paths in its set of paths (up to f+1)
+        self.disjoint_frozen = BoundedSet(*bounds) # Set of keys with f+1 disjoint paths, for which the count is no longer updated
         
-        self.sent_echo = set()
-        self.sent_ready = set()
-        self.bracha_delivered = set()
-        self.echos = defaultdict(set)
-        self.readys = defaultdict(set)
+        self.bracha = BoundedDict(*bounds) # Dict mapping a bracha key to its BrachaState
 
     async def on_start(self) -> None:
         print(f"[Start] Node {self.node_id} initialized with f={self.f}, message delay [{self.min_message_delay}, {self.max_message_delay}], NUM_BROADCASTS={self.num_messages_to_broadcast}, Byzantine Behavior={self.byzantine_behavior}, Nodes={self.num_nodes}")
@@ -61,16 +100,19 @@ class BrachaAlgorithm(DistributedAlgorithm):
 
         if self.num_messages_to_broadcast > 0:
             print(f"[Start] Node {self.node_id} Broadcasting {self.num_messages_to_broadcast} message(s)")
+            broadcasts = []
             for msg in range(self.num_messages_to_broadcast):
                 content = f"Message {msg} from node {self.node_id}"
 
                 # Byzantine behavior: limited_broadcast
                 if self.byzantine_behavior == 'limited_broadcast':
-                    await self.do_limited_broadcast(content, self.node_id, "SEND")
+                    broadcasts.append(self.do_limited_broadcast(content, self.node_id, "SEND"))
                 else:
                     #await self.do_dolev_broadcast(content, self.node_id, "SEND") # TEMP: ECHO implies SEND
                     message = DolevMessage(content, self.node_id, "SEND", self.node_id, (), ())
-                    await self.do_dolev_deliver(message)
+                    broadcasts.append(self.do_dolev_deliver(message))
+            # Start all broadcasts together, instead of one after the other
+            await asyncio.gather(*broadcasts)
 
         # Byzantine collude behavior: Try to forge messages from a correct node
         if self.byzantine_behavior == 'collude':
@@ -78,25 +120,32 @@ class BrachaAlgorithm(DistributedAlgorithm):
                 forged_sender_id = 0
                 forged_content = f"FORGED MESSAGE claiming to be from node {forged_sender_id}"
                 print(f"[Byzantine-Collude] Node {self.node_id}: Attempting to forge message from node {forged_sender_id}")
-                await self.do_dolev_broadcast(forged_content, forged_sender_id, "SEND")
-                await self.do_dolev_broadcast(forged_content, forged_sender_id, "ECHO")
-                await self.do_dolev_broadcast(forged_content, forged_sender_id, "READY")
+                await asyncio.gather(*[self.do_dolev_broadcast(forged_content, forged_sender_id, msg_type)
+                                       for msg_type in ("SEND", "ECHO", "READY")])
                 
+    def send_now(self, peer: Peer, payload: DolevMessage) -> None:
+        # Messages to the same peer are sent together (see flush_peer)
+        pending = self.pending[peer]
+        pending.append(payload)
+        if len(pending) == 1:
+            self.register_anonymous_task("flush_peer", self.flush_peer, peer, delay=self.flush_interval)
+
+    def flush_peer(self, peer: Peer) -> None:
+        messages = self.pending.pop(peer, [])
+        if len(messages) == 1:
+            self.ez_send(peer, messages[0])
+        elif messages:
+            self.ez_send(peer, DolevBatch(messages))
+
     async def send_message_to_peers(self, message: DolevMessage, path, peers=None) -> None:
-        message.path = path
+        # Sends are deferred, so send a copy with the new path: the received message may be relayed again
+        # (with another path) or read by the receive-side state before the send is done
+        message = DolevMessage(message.content, message.broadcast_sender_id, message.msg_type,
+                               message.dolev_sender_id, path, message.intended_targets)
 
-        async def send_with_delay(peer):
-            delay = random.uniform(self.min_message_delay, self.max_message_delay)
-            await asyncio.sleep(delay)
-            self.ez_send(peer, message)
-            
         if peers == None:
-            peers = self.get_peers()
-        tasks = []
-        for peer in peers:
-            tasks.append(asyncio.create_task(send_with_delay(peer)))
-        
-        await asyncio.gather(*tasks)
+            peers = [peer for peer, _ in self.get_peers_snapshot()]
+        self.enqueue_sends(peers, message)
 
     async def do_dolev_broadcast(self, content: str, broadcast_sender_id: str, msg_type: str) -> None:
         print(f"[BROADCASTING] {self.node_id}  - {msg_type} {broadcast_sender_id} {content}")
@@ -134,13 +183,31 @@ class BrachaAlgorithm(DistributedAlgorithm):
 
         await self.do_dolev_deliver(payload)'''  
 
+    def rotate_dedup_caches(self) -> None:
+        self.raw_cache.rotate()
+        self.path_cache.rotate()
+
+    def on_raw_dolev_message(self, source_address, data: bytes):
+        # Drop byte-identical retransmissions before decoding them
+        if self.raw_cache.check_and_put(data):
+            return None
+        return self.on_ipv8_message(source_address, data)
+
     @message_wrapper(DolevMessage)
     async def on_ipv8_message(self, peer: Peer, message: DolevMessage) -> None:
+        await self.process_dolev_message(peer, message)
+
+    @message_wrapper(DolevBatch)
+    async def on_dolev_batch(self, peer: Peer, batch: DolevBatch) -> None:
+        for message in batch.msgs:
+            await self.process_dolev_message(peer, message)
+
+    async def process_dolev_message(self, peer: Peer, message: DolevMessage) -> None:
         #if self.byzantine_behavior != 'none':
         #    await self.do_byzantine(peer, message)
         #    return
 
-        real_sender_id = self.node_id_from_peer(peer)
+        real_sender_id = self.peer_id(peer)
         key = message.dolev_key
 
         if real_sender_id == message.dolev_sender_id: # Optimization 1
@@ -151,22 +218,31 @@ class BrachaAlgorithm(DistributedAlgorithm):
             return
         
         if len(message.path) == 0: # Optimization 3
-            if not key in self.who_delivered:
-                self.who_delivered[key] = set()
-            self.who_delivered[key].add(real_sender_id)
+            self.who_delivered.setdefault(key, set()).add(real_sender_id)
+
+        path = message.path + (real_sender_id,)
+
+        # Drop messages that arrived over this exact path before
+        if self.path_cache.check_and_put(repr((key, path)).encode()):
+            return
 
-        path = tuple(message.path) + (real_sender_id,)
-        self.paths[key].add(path)
+        if first_hop_insert(self.paths.setdefault(key, {}), path):
+            # Only recount for new paths, and stop counting once there are enough.
+            # Fewer than f+1 first hops can never hold f+1 disjoint paths, so those are not counted at all
+            if key not in self.disjoint_frozen and len(self.paths[key]) >= self.f + 1:
+                self.disjoint_count[key] = count_disjoint_paths(kept_paths(self.paths[key]), limit=self.f + 1)
+                if self.disjoint_count[key] >= self.f + 1:
+                    self.disjoint_frozen.add(key)
 
-        num_disjoint_paths = count_disjoint_paths(self.paths[key]) if key in self.paths else 0
+        num_disjoint_paths = self.disjoint_count.get(key, 0)
 
         if (num_disjoint_paths >= self.f + 1 and key not in self.delivered):
             await self.do_dolev_deliver(message)
         
-        peers = self.get_peers()
-        peers_to_send = [peer for peer in peers if self.node_id_from_peer(peer) not in self.who_delivered[key]] # Optimization 3
+        who_delivered = self.who_delivered.get(key, EMPTY_FROZENSET)
+        peers_to_send = [peer for peer, peer_id in self.get_peers_snapshot() if peer_id not in who_delivered] # Optimization 3
 
-        if any([node_id in message.path for node_id in self.who_delivered[key]]): # Optimization 4
+        if not who_delivered.isdisjoint(message.path): # Optimization 4
             return
         
         if not key in self.delivered:
@@ -191,30 +267,33 @@ class BrachaAlgorithm(DistributedAlgorithm):
         print(f"[Dolev] Node {self.node_id}: Message is delivered from sender {message.dolev_sender_id} [{message.broadcast_sender_id}: \"{message.content}\"] (type: {message.msg_type})")
 
         key = message.bracha_key
+        state = self.bracha.get(key)
+        if state is None:
+            state = self.bracha[key] = BrachaState()
         #if message.msg_type == "SEND":
         if message.msg_type == "SEND" or (message.msg_type == "ECHO" and message.broadcast_sender_id == message.dolev_sender_id): # Optimization 2: ECHO from source implies SEND
-            if not key in self.sent_echo:
-                self.sent_echo.add(key)
+            if not state.sent_echo:
+                state.sent_echo = True
                 await self.do_dolev_broadcast_if_close(message.content, message.broadcast_sender_id, "ECHO")
 
         elif message.msg_type == "ECHO":
-            self.echos[key].add(message.dolev_sender_id)
-            if len(self.echos[key]) >= math.ceil((self.num_nodes + self.f + 1) / 2) and not key in self.sent_ready:
-                self.sent_ready.add(key)
+            state.echos.add(message.dolev_sender_id)
+            if len(state.echos) >= math.ceil((self.num_nodes + self.f + 1) / 2) and not state.sent_ready:
+                state.sent_ready = True
                 await self.do_dolev_broadcast_if_close(message.content, message.broadcast_sender_id, "READY")
 
-            if len(self.echos[key]) >= self.f+1 and key not in self.sent_echo: # Optimization 1
-                self.sent_echo.add(key)
+            if len(state.echos) >= self.f+1 and not state.sent_echo: # Optimization 1
+                state.sent_echo = True
                 await self.do_dolev_broadcast_if_close(message.content, message.broadcast_sender_id, "ECHO")
 
         elif message.msg_type == "READY":
-            self.readys[key].add(message.dolev_sender_id)
-            if len(self.readys[key]) >= self.f+1 and not key in self.sent_ready:
-                self.sent_ready.add(key)
+            state.readys.add(message.dolev_sender_id)
+            if len(state.readys) >= self.f+1 and not state.sent_ready:
+                state.sent_ready = True
                 await self.do_dolev_broadcast_if_close(message.content, message.broadcast_sender_id, "READY")
 
-            if len(self.readys[key]) >= 2*self.f+1 and not key in self.bracha_delivered:
-                self.do_bracha_deliver(message)
+            if len(state.readys) >= 2*self.f+1 and not state.delivered:
+                self.do_bracha_deliver(message, state)
 
         
         if message.msg_type == "READY": # Optimization 1
@@ -222,24 +301,6 @@ class BrachaAlgorithm(DistributedAlgorithm):
             if echo_message.dolev_key not in self.delivered: # READY message is Dolev-delivered but ECHO not yet. Deliver the ECHO now as well
                 await self.do_dolev_deliver(echo_message)
 
-    def do_bracha_deliver(self, payload: DolevMessage) -> None:
-        self.bracha_delivered.add(payload.bracha_key)
+    def do_bracha_deliver(self, payload: DolevMessage, state: BrachaState) -> None:
+        state.delivered = True
         print(f"[Bracha] Node {self.node_id}: Broadcast is delivered [{payload.broadcast_sender_id}: \"{payload.content}\"]")
-
-
-def count_disjoint_paths(paths):
-    sets = [set(s[1:]) for s in paths]
-    n = len(sets)
-    best = 0
-
-    def backtrack(i, chosen, used):
-        nonlocal best
-        if i == n:
-            best = max(best, len(chosen))
-            return
-        backtrack(i + 1, chosen, used)
-        if sets[i].isdisjoint(used):
-            backtrack(i + 1, chosen + [i], used | sets[i])
-
-    backtrack(0, [], set())
-    return best
\ No newline at end of file
@@ -1,8 +1,12 @@
 from typing import Tuple
 from cs4545.system.da_types import *
+from cs4545.system.bounded_dict import BoundedDict, BoundedSet, state_bounds
+from cs4545.system.disjoint_paths import first_hop_insert, kept_paths, count_disjoint_paths
+from cs4545.system.send_mixins import DelayedSends, PeerSnapshot
 import os
 import random
-import asyncio
+
+EMPTY_FROZENSET = frozenset() # Default for set lookups, so a missing key does not build a new set
 
 @dataclass(msg_id=3)
 class MyMessage:
@@ -10,8 +14,11 @@ class MyMessage:
     message: str
     path: Tuple[int]
 
+    fix_unpack_message = classmethod(intern_unpacked)  # Called by ipv8 on deserialization
+    fix_unpack_path = classmethod(tuple_unpacked)
+
 
-class DolevAlgorithm(DistributedAlgorithm):
+class DolevAlgorithm(DelayedSends, PeerSnapshot, DistributedAlgorithm):
     def __init__(self, settings: CommunitySettings) -> None:
         super().__init__(settings)
         self.add_message_handler(MyMessage, self.on_message)
@@ -25,8 +32,12 @@ class DolevAlgorithm(DistributedAlgorithm):
 
         self.num_messages_to_broadcast = int(os.getenv('NUM_BROADCASTS', '1'))
 
-        self.delivered = {} # Dict mapping (message, sender_id, message_id) to node_ids that delivered it
-        self.paths = {} # Dict mapping (message, sender_id, message_id) to set of paths (tuples of node_ids)
+        # Per-message state is bounded by size and age (see state_bounds)
+        bounds = state_bounds()
+        self.delivered = BoundedDict(*bounds) # Dict mapping (message, sender_id, message_id) to node_ids that delivered it
+        self.paths = BoundedDict(*bounds) # Dict mapping (message, sender_id, message_id) to the received paths by first hop (see first_hop_insert)
+        self.disjoint_count = BoundedDict(*bounds) # Dict mapping a key to the number of disjoint paths in its set of paths (up to f+1)
+        self.disjoint_frozen = BoundedSet(*bounds) # Set of keys with f+1 disjoint paths, for which the count is no longer updated
 
     async def on_start(self):
         print(f"Node {self.node_id} initialized with f={self.f}, message delay [{self.min_message_delay}, {self.max_message_delay}], NUM_BROADCASTS={self.num_messages_to_broadcast}")
@@ -45,25 +56,16 @@ class DolevAlgorithm(DistributedAlgorithm):
             self.do_deliver(message, self.node_id)
         
     async def send_message_to_peers(self, payload: MyMessage, path) -> None:
-        async def send_with_delay(peer):
-            delay = random.uniform(self.min_message_delay, self.max_message_delay)
-            await asyncio.sleep(delay)
-            self.ez_send(peer, MyMessage(payload.sender_id, payload.message, path))
-            
-        peers = self.get_peers()
-        key = (payload.message, payload.sender_id)
-        tasks = []
-        for peer in peers:
-            peer_id = self.node_id_from_peer(peer)
-            if (peer_id in path) \
-                or (key in self.delivered and peer_id in self.delivered[key]):
-                continue
-            tasks.append(asyncio.create_task(send_with_delay(peer)))
-        
-        await asyncio.gather(*tasks)
+        message = MyMessage(payload.sender_id, payload.message, path)
+        # Bind to locals, so the filter below does not look up attributes for every peer
+        path_set = frozenset(path)
+        delivered = self.delivered.get((payload.message, payload.sender_id), EMPTY_FROZENSET)
+        targets = [peer for peer, peer_id in self.get_peers_snapshot()
+                   if peer_id not in path_set and peer_id not in delivered]
+        self.enqueue_sends(targets, message)
         
     async def do_byzantine(self, peer: Peer, payload: MyMessage) -> None:
-        sender_id = self.node_id_from_peer(peer)
+        sender_id = self.peer_id(peer)
         if self.byzantine_behavior == 'drop':
             print(f"[Node {self.node_id}] Byzantine: Dropping message from node {sender_id}.")
             return
@@ -90,7 +92,7 @@ class DolevAlgorithm(DistributedAlgorithm):
                 await self.do_byzantine(peer, payload)
                 return
             
-            sender_id = self.node_id_from_peer(peer)
+            sender_id = self.peer_id(peer)
             key = (payload.message, payload.sender_id)
             print(
                 f"[Node {self.node_id}] Got a message from node: {sender_id}.\t")
@@ -105,20 +107,25 @@ class DolevAlgorithm(DistributedAlgorithm):
                     self.delivered[key] = set([sender_id])
 
             self.append_output(f"{sender_id}-{payload}")
-            path = tuple(payload.path) + (sender_id,)
+            path = payload.path + (sender_id,)
 
-            nodes_that_delivered = self.delivered.get(key, set())
-            path_contains_delivered_node = any(node in nodes_that_delivered for node in path)
+            # Like the disjoint path count, ignore the first node of the path: it has always delivered
+            nodes_that_delivered = self.delivered.get(key, EMPTY_FROZENSET)
+            path_contains_delivered_node = not nodes_that_delivered.isdisjoint(path[1:])
 
             if path_contains_delivered_node:
                 return
             
-            if key not in self.paths:
-                self.paths[key] = set()
-            self.paths[key].add(path)
-                
-            num_disjoint_paths = count_disjoint_paths(self.paths[key]) if key in self.paths else 0
-            if (num_disjoint_paths >= self.f + 1 and key not in self.delivered) \
+            if first_hop_insert(self.paths.setdefault(key, {}), path):
+                # Only recount for new paths, and stop counting once there are enough.
+                # Fewer than f+1 first hops can never hold f+1 disjoint paths, so those are not counted at all
+                if key not in self.disjoint_frozen and len(self.paths[key]) >= self.f + 1:
+                    self.disjoint_count[key] = count_disjoint_paths(kept_paths(self.paths[key]), limit=self.f + 1)
+                    if self.disjoint_count[key] >= self.f + 1:
+                        self.disjoint_frozen.add(key)
+
+            num_disjoint_paths = self.disjoint_count.get(key, 0)
+            if (num_disjoint_paths >= self.f + 1 and self.node_id not in nodes_that_delivered) \
                 or (sender_id == payload.sender_id):
                 self.do_deliver(payload.message, payload.sender_id)
                 
@@ -134,20 +141,3 @@ class DolevAlgorithm(DistributedAlgorithm):
         print(f"Node {self.node_id}: Message is delivered from sender {sender_id} [\"{message}\"]")
         key = (message, sender_id)
         self.delivered[key] = set([self.node_id])
-
-def count_disjoint_paths(paths):
-    sets = [set(s[1:]) for s in paths]
-    n = len(sets)
-    best = 0
-
-    def backtrack(i, chosen, used):
-        nonlocal best
-        if i == n:
-            best = max(best, len(chosen))
-            return
-        backtrack(i + 1, chosen, used)
-        if sets[i].isdisjoint(used):
-            backtrack(i + 1, chosen + [i], used | sets[i])
-
-    backtrack(0, [], set())
-    return best
\ No newline at end of file
@@ -1,58 +1,140 @@
-import json
-from typing import Tuple
+import os
+import struct
+import numpy as np
+from collections import defaultdict
+from typing import Tuple, List, Set, Optional, Union
 from cs4545.system.da_types import *
 from cs4545.implementation.bracha_algorithm import BrachaAlgorithm, BrachaMessage
 
-@dataclass(msg_id=6)
+# Tag byte in front of every RCO payload carried by the Bracha layer
+RCO_PAYLOAD = b'R'
+# Tag byte in front of a batch of RCO payloads, each prefixed with its length, carried by one Bracha broadcast
+RCO_BATCH_PAYLOAD = b'r'
+RCO_FRAME_LENGTH = struct.Struct("!I")
+
+# Header of an RCO payload: sender_id, vector clock length and number of nonzero entries. It is followed by
+# the indices and values of the nonzero entries (the other entries are 0) and the content
+RCO_HEADER = struct.Struct("!HHH")
+_payload_structs: Dict[int, struct.Struct] = {}
+
+
+def payload_struct(num_nonzero: int) -> struct.Struct:
+    """Struct for the tag, header and num_nonzero vector clock entries of an RCO payload, created once per count"""
+    rco_struct = _payload_structs.get(num_nonzero)
+    if rco_struct is None:
+        rco_struct = _payload_structs[num_nonzero] = struct.Struct(f"!{len(RCO_PAYLOAD)}sHHH{num_nonzero}H{num_nonzero}I")
+    return rco_struct
+
+
+# Up to this many nodes, the vector clocks are also packed into one int with a lane of VC_LANE_BITS bits per
+# entry, so checking a message against the local VC takes a few int operations instead of numpy calls
+PACKED_VC_MAX_NODES = 8
+VC_LANE_BITS = 32
+VC_LANE_MAX = (1 << (VC_LANE_BITS - 1)) - 1  # The top bit of each lane is kept free for the comparison
+
+
+def pack_vector_clock(vector_clock) -> int:
+    """Pack a vector clock into one int, entry i in lane i (entries above VC_LANE_MAX, which the local VC
+    never reaches, are clamped so they cannot spill into the next lane)"""
+    packed = 0
+    for i, value in enumerate(vector_clock):
+        packed |= min(value, VC_LANE_MAX) << (VC_LANE_BITS * i)
+    return packed
+
+
 class RCOMessage:
-    """RCO layer message - for Reliable Causal Order broadcast"""
-    sender_id: int
-    content: str
-    vector_clock: Tuple[int, ...]
-    
+    """
+    RCO layer message - for Reliable Causal Order broadcast
+
+    Only ever sent inside a Bracha message (see to_bytes), so it is a plain slotted class instead
+    of an ipv8 payload, whose generated __init__ would replace the one below (and skip the key).
+    """
+    __slots__ = ('sender_id', 'content', 'vector_clock', 'key')
+
     def __init__(self, sender_id: int, content: str, vector_clock: Tuple[int, ...]):
         self.sender_id = sender_id
         self.content = content
         self.vector_clock = vector_clock
-    
-    @property
-    def key(self):
-        return (self.sender_id, self.content)
-
-    def to_json(self) -> str:
-        """Serialize for passing to Bracha layer"""
-        return json.dumps({
-            'content': self.content,
-            'vector_clock': list(self.vector_clock),
-            'sender_id': self.sender_id
-        })
+        # Built once, it is looked up in several tables for every received message
+        self.key = (sender_id, content)
+
+    def to_bytes(self) -> bytes:
+        """Serialize for passing to Bracha layer, with only the nonzero entries of the vector clock"""
+        indices = [i for i, value in enumerate(self.vector_clock) if value]
+        # Tag, header and vector clock are packed by a single call, only the content is appended
+        return payload_struct(len(indices)).pack(
+            RCO_PAYLOAD, self.sender_id, len(self.vector_clock), len(indices),
+            *indices, *(self.vector_clock[i] for i in indices)
+        ) + self.content.encode()
 
     @staticmethod
-    def from_json(json_str: str) -> 'RCOMessage':
+    def from_bytes(data: bytes) -> 'RCOMessage':
         """Deserialize from Bracha layer"""
-        obj = json.loads(json_str)
+        num_nonzero = RCO_HEADER.unpack_from(data, len(RCO_PAYLOAD))[2]
+        rco_struct = payload_struct(num_nonzero)
+        _, sender_id, num_entries, _, *entries = rco_struct.unpack_from(data)
+        vector_clock = [0] * num_entries
+        for i, value in zip(entries[:num_nonzero], entries[num_nonzero:]):
+            vector_clock[i] = value
         return RCOMessage(
-            content=obj['content'],
-            vector_clock=tuple(obj['vector_clock']),
-            sender_id=obj['sender_id']
+            content=data[rco_struct.size:].decode(),
+            vector_clock=tuple(vector_clock),
+            sender_id=sender_id
         )
 
+    @staticmethod
+    def to_batch(messages: List['RCOMessage']) -> bytes:
+        """Serialize several messages for passing to Bracha layer as one payload"""
+        frames = [message.to_bytes() for message in messages]
+        return RCO_BATCH_PAYLOAD + b"".join(RCO_FRAME_LENGTH.pack(len(frame)) + frame for frame in frames)
+
+    @staticmethod
+    def from_batch(data: bytes) -> List['RCOMessage']:
+        """Deserialize a batch from Bracha layer"""
+        messages = []
+        offset = len(RCO_BATCH_PAYLOAD)
+        while offset < len(data):
+            (length,) = RCO_FRAME_LENGTH.unpack_from(data, offset)
+            offset += RCO_FRAME_LENGTH.size
+            messages.append(RCOMessage.from_bytes(data[offset:offset + length]))
+            offset += length
+        return messages
+
 
 class RCOAlgorithm(BrachaAlgorithm):
     def __init__(self, settings: CommunitySettings) -> None:
         super().__init__(settings)
-        
-        self.vector_clock: list[int] = [0] * self.num_nodes
-        self.pending = set()   # Pending set of RCOMessages (sender_id, content, vector_clock)
-        self.rco_delivered: Dict[Tuple[int, str], bool] = {}
+
+        self._log_rco = self.debug_mode >= 1 and self.debug_algorithm in ('all', 'rco')
+        self._trace_rco = self.debug_mode >= 2 and self.debug_algorithm in ('all', 'rco')
+
+        self.vector_clock = np.zeros(self.num_nodes, dtype=np.int32)
+        # Tuple copy of the VC sent with broadcasts, rebuilt only after the VC changed (None until then)
+        self._vc_snapshot: Optional[Tuple[int, ...]] = None
+        # Pending RCOMessages: (sender_id, content) -> vector_clock (packed, see pack_vector_clock, for small VCs)
+        self.pending: Dict[Tuple[int, str], Union[np.ndarray, int]] = {}
+        if self.num_nodes <= PACKED_VC_MAX_NODES:
+            self._vc_packed: Optional[int] = 0
+            self._lane_msbs = sum((VC_LANE_MAX + 1) << (VC_LANE_BITS * i) for i in range(self.num_nodes))
+            self._as_vector_clock = pack_vector_clock
+            self._blocking_entry = self._blocking_entry_packed
+        else:
+            self._vc_packed = None
+        # Keys of pending messages by the first entry at which the local VC is behind theirs (-1 if none),
+        # so a VC increment only rechecks the messages that were waiting on that entry
+        self._blocked_by: Dict[int, Set[Tuple[int, str]]] = defaultdict(set)
+        self.rco_delivered: Set[Tuple[int, str]] = set()
+
+        # Number of messages from on_start that share one Bracha broadcast
+        self.rco_batch_size = max(1, int(os.getenv('RCO_BATCH_SIZE', '1')))
 
     async def on_start(self) -> None:
         # Make sure to call this one last in this function
         await super().on_start()
         
-        for i in range(self.num_messages_to_broadcast):
-            message_content = f"Message-{i}"
-            await self.rco_broadcast(message_content)
+        message_contents = [f"Message-{i}" for i in range(self.num_messages_to_broadcast)]
+        for start in range(0, len(message_contents), self.rco_batch_size):
+            await self.rco_broadcast_batch(message_contents[start:start + self.rco_batch_size])
 
     async def brb_deliver(self, msg: BrachaMessage) -> None:
         """
@@ -61,24 +143,36 @@ class RCOAlgorithm(BrachaAlgorithm):
                 pending := pending U (pi, [DATA, VCm, m])
                 deliver-pending
         """
-        # Deserialize rco message
-        try:
-            rco_msg = RCOMessage.from_json(msg.content)
-        except:
-            # If not a Bracha message, call parent's brb_deliver
+        # Deserialize rco message(s), recognized by their tag (plain Bracha broadcasts carry str content)
+        content = msg.content
+        if isinstance(content, bytes) and content.startswith(RCO_PAYLOAD):
+            rco_msgs = [RCOMessage.from_bytes(content)]
+        elif isinstance(content, bytes) and content.startswith(RCO_BATCH_PAYLOAD):
+            rco_msgs = RCOMessage.from_batch(content)
+        else:
+            # If not an RCO message, call parent's brb_deliver
             await super().brb_deliver(msg)
             return
 
         # Byzantine Behavior: Message Dropping at RCO layer
         if self.byzantine_behavior == 'rco_drop_messages':
-            if self.debug_mode >= 1:
-                print(f"[BYZANTINE-RCO] Node {self.node_id}: Dropping message from {rco_msg.sender_id}: \"{rco_msg.content}\"")
+            if self._log_rco:
+                for rco_msg in rco_msgs:
+                    print(f"[BYZANTINE-RCO] Node {self.node_id}: Dropping message from {rco_msg.sender_id}: \"{rco_msg.content}\"")
             return  # Drop the message
 
-        if rco_msg.sender_id != self.node_id and not self.rco_delivered.get(rco_msg.key, False):
-            self.pending.add((rco_msg.sender_id, rco_msg.content, rco_msg.vector_clock))
-            if self.debug_mode >= 2 and self.debug_algorithm in ['all', 'rco']:
-                print(f"[RCO-RECEIVE] Node {self.node_id}: Received message from {rco_msg.sender_id}: \"{rco_msg.content}\" | VC_msg={rco_msg.vector_clock}, VC_local={self.vector_clock}")
+        for rco_msg in rco_msgs:
+            # The message key dedups retransmissions, without hashing the vector clock
+            key = rco_msg.key
+            if rco_msg.sender_id != self.node_id and key not in self.rco_delivered and key not in self.pending:
+                msg_vector_clock = self._as_vector_clock(rco_msg.vector_clock)
+                self.pending[key] = msg_vector_clock
+                self._blocked_by[self._blocking_entry(msg_vector_clock)].add(key)
+                if self._trace_rco:
+                    print(f"[RCO-RECEIVE] Node {self.node_id}: Received message from {rco_msg.sender_id}: \"{rco_msg.content}\" | VC_msg={list(rco_msg.vector_clock)}, VC_local={self.vector_clock.tolist()}")
+        # deliver_pending always empties the ready bucket, so it only has work if a message above was ready
+        # (duplicates and messages that still wait on the local VC skip it)
+        if self._blocked_by.get(-1):
             await self.deliver_pending()
             
     async def rco_broadcast(self, msg_content: str) -> None:
@@ -88,40 +182,62 @@ class RCOAlgorithm(BrachaAlgorithm):
             2. trigger < rbBroadcast | [DATA, VC, m] >
             3. VC[rank(self)] := VC[rank(self)] + 1
         """
-        if self.debug_mode >= 1 and self.debug_algorithm in ['all', 'rco']:
+        rco_msg = await self._start_rco_broadcast(msg_content)
+        await self.brb_broadcast(rco_msg.to_bytes())
+
+        self._increment_vector_clock(self.node_id)
+        await self.deliver_pending()
+
+    async def rco_broadcast_batch(self, msg_contents: List[str]) -> None:
+        """rco_broadcast of several messages, carried by a single Bracha broadcast"""
+        if len(msg_contents) == 1:
+            await self.rco_broadcast(msg_contents[0])
+            return
+
+        # Each message gets the VC it would have had if broadcast on its own
+        rco_msgs = []
+        for msg_content in msg_contents:
+            rco_msgs.append(await self._start_rco_broadcast(msg_content))
+            self._increment_vector_clock(self.node_id)
+        await self.brb_broadcast(RCOMessage.to_batch(rco_msgs))
+
+        await self.deliver_pending()
+
+    async def _start_rco_broadcast(self, msg_content: str) -> RCOMessage:
+        """Deliver a message to ourselves and create the RCOMessage to broadcast, with the current VC"""
+        if self._log_rco:
             print(f"[RCO-BROADCAST] Node {self.node_id}: Broadcasting message [{self.node_id}: \"{msg_content}\"]")
         await self.rco_deliver(self.node_id, msg_content)
 
-        vector_clock_to_send = tuple(self.vector_clock)
+        if self._vc_snapshot is None:
+            self._vc_snapshot = tuple(self.vector_clock.tolist())
+        vector_clock_to_send = self._vc_snapshot
 
         # Byzantine Behavior: Vector Clock Inflation
         # Send messages with inflated vector clocks to delay delivery at correct nodes
         if self.byzantine_behavior == 'vc_inflation':
-            inflated_vc = [vc + 10 for vc in self.vector_clock]
+            inflated_vc = (self.vector_clock + 10).tolist()
             vector_clock_to_send = tuple(inflated_vc)
-            if self.debug_mode >= 1:
-                print(f"[BYZANTINE-RCO] Node {self.node_id}: Inflating VC from {self.vector_clock} to {inflated_vc}")
+            if self._log_rco:
+                print(f"[BYZANTINE-RCO] Node {self.node_id}: Inflating VC from {self.vector_clock.tolist()} to {inflated_vc}")
 
         # Byzantine Behavior: Vector Clock Deflation/Forgery
         # Send messages with zero or minimal vector clocks to bypass causal order
         elif self.byzantine_behavior == 'vc_deflation':
             deflated_vc = [0] * self.num_nodes
             vector_clock_to_send = tuple(deflated_vc)
-            if self.debug_mode >= 1:
-                print(f"[BYZANTINE-RCO] Node {self.node_id}: Deflating VC from {self.vector_clock} to {deflated_vc}")
+            if self._log_rco:
+                print(f"[BYZANTINE-RCO] Node {self.node_id}: Deflating VC from {self.vector_clock.tolist()} to {deflated_vc}")
 
-        rco_msg = RCOMessage(
+        return RCOMessage(
             sender_id=self.node_id,
             content=msg_content,
             vector_clock=vector_clock_to_send,
         )
-        await self.brb_broadcast(rco_msg.to_json())
-
-        self.vector_clock[self.node_id] += 1
 
     async def rco_deliver(self, msg_sender_id: int, msg_content: str) -> None:
-        if self.debug_mode >= 1 and self.debug_algorithm in ['all', 'rco']:
-            print(f"[RCO-DELIVER] Node {self.node_id}: Delivered message from sender {msg_sender_id}: \"{msg_content}\" | VC={self.vector_clock}")
+        if self._log_rco:
+            print(f"[RCO-DELIVER] Node {self.node_id}: Delivered message from sender {msg_sender_id}: \"{msg_content}\" | VC={self.vector_clock.tolist()}")
 
     async def deliver_pending(self) -> None:
         """
@@ -133,31 +249,43 @@ class RCOAlgorithm(BrachaAlgorithm):
                 trigger ( rcoDeliver | sx, x )
                 VC[rank(sx)] := VC[rank(sx)] + 1
         """
-        delivered_any = True
-
-        # keep trying to deliver, because delivering a message increases our VC
+        # Keep trying to deliver, because delivering a message increases our VC
         # which might allow other messages to be delivered as well
-        while delivered_any:
-            delivered_any = False
+        while self._blocked_by.get(-1):
+            key = self._blocked_by[-1].pop()
+            del self.pending[key]
+            msg_sender_id, msg_content = key
 
-            # Find a message that can be delivered
-            for pending_item in list(self.pending):
-                msg_sender_id, msg_content, msg_vector_clock = pending_item
-                msg_vector_clock = list(msg_vector_clock)
+            await self.rco_deliver(msg_sender_id, msg_content)
+            self.rco_delivered.add(key)
 
-                # Check if all entries in local VC are >= corresponding entries in message VC
-                can_deliver = all(
-                    self.vector_clock[i] >= msg_vector_clock[i]
-                    for i in range(len(self.vector_clock))
-                )
+            self._increment_vector_clock(msg_sender_id)
 
-                if can_deliver:
-                    self.pending.remove(pending_item)
+    def _as_vector_clock(self, vector_clock: Tuple[int, ...]) -> np.ndarray:
+        """The vector clock of a received message, as it is stored in pending"""
+        return np.array(vector_clock, dtype=np.int32)
 
-                    await self.rco_deliver(msg_sender_id, msg_content)
-                    self.rco_delivered[(msg_sender_id, msg_content)] = True
+    def _blocking_entry(self, msg_vector_clock: np.ndarray) -> int:
+        """First entry at which the local VC is behind msg_vector_clock, or -1 if the message can be delivered"""
+        # argmax stops at the first True, without building an index array of all entries that are behind
+        behind = msg_vector_clock > self.vector_clock
+        entry = int(behind.argmax())
+        return entry if behind[entry] else -1
 
-                    self.vector_clock[msg_sender_id] += 1
+    def _blocking_entry_packed(self, msg_vector_clock: int) -> int:
+        """_blocking_entry for packed vector clocks"""
+        # With the top bit of every local lane set, the subtraction never borrows across lanes,
+        # and a lane keeps its top bit exactly when the local entry is at least the message entry
+        behind = ~((self._vc_packed | self._lane_msbs) - msg_vector_clock) & self._lane_msbs
+        if not behind:
+            return -1
+        return ((behind & -behind).bit_length() - 1) // VC_LANE_BITS
 
-                    delivered_any = True
-                    break
\ No newline at end of file
+    def _increment_vector_clock(self, entry: int) -> None:
+        """Increment an entry of the local VC and recheck only the pending messages that were waiting on it"""
+        self.vector_clock[entry] += 1
+        if self._vc_packed is not None:
+            self._vc_packed += 1 << (VC_LANE_BITS * entry)
+        self._vc_snapshot = None
+        for waiting in self._blocked_by.pop(entry, ()):
+            self._blocked_by[self._blocking_entry(self.pending[waiting])].add(waiting)
@@ -0,0 +1,74 @@
+import os
+import time
+from collections import OrderedDict
+
+
+class BoundedDict(OrderedDict):
+    """
+    Dict that holds at most capacity entries, each for at most ttl seconds after it was last written.
+
+    Writes (including setdefault) move an entry to the end, so the least recently written entries
+    are at the front and are dropped first. Expired entries are dropped on writes, so a node that
+    keeps receiving messages also keeps its state bounded. on_evict, if given, is called with the key
+    and value of every entry dropped this way.
+    """
+    def __init__(self, capacity: int, ttl: float = None, on_evict=None):
+        super().__init__()
+        self.capacity = capacity
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.__written = {}  # Last write time per key
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        now = time.monotonic()
+        self.__written[key] = now
+        self.__evict(now)
+
+    # On Python 3.8 OrderedDict.pop and popitem call __delitem__, so every removal tolerates a missing write time
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.__written.pop(key, None)
+
+    def pop(self, key, *default):
+        self.__written.pop(key, None)
+        return super().pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            self.move_to_end(key)
+            self.__written[key] = time.monotonic()
+            return self[key]
+        self[key] = default
+        return default
+
+    def __evict(self, now: float):
+        while len(self) > self.capacity:
+            self.__drop_oldest()
+        if self.ttl is not None:
+            deadline = now - self.ttl
+            while self and self.__written[next(iter(self))] < deadline:
+                self.__drop_oldest()
+
+    def __drop_oldest(self):
+        key, value = self.popitem(last=False)
+        self.__written.pop(key, None)
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+
+class BoundedSet(BoundedDict):
+    """Set with the capacity and ttl of BoundedDict"""
+    def add(self, key):
+        self[key] = True
+
+
+def state_bounds():
+    """
+    (capacity, ttl) for per-message state, from DEDUP_CAPACITY and DEDUP_TTL
+
+    Per-message state is dropped after DEDUP_TTL seconds without updates, or when there are more
+    than DEDUP_CAPACITY messages, so it does not grow for the whole life of a node.
+    """
+    return int(os.getenv('DEDUP_CAPACITY', '10000')), float(os.getenv('DEDUP_TTL', '600'))
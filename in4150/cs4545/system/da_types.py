@@ -29,6 +29,16 @@ def sizeof(obj):
     return size
 
 
+def intern_unpacked(cls, value):
+    """fix_unpack hook (see ipv8 dataclass payloads): intern a string, it is hashed in every key lookup"""
+    return sys.intern(value)
+
+
+def tuple_unpacked(cls, value):
+    """fix_unpack hook (see ipv8 dataclass payloads): lists are unpacked as lists, store them as a tuple once"""
+    return tuple(value)
+
+
 DataclassPayload = typing.TypeVar("DataclassPayload")
 AnyPayload = typing.Union[Payload, DataclassPayload]
 
@@ -173,14 +183,28 @@ class DistributedAlgorithm(Community):
 
         self.register_anonymous_task("delayed_stop", delayed_stop, delay=delay)
 
-    def ez_send(self, peer: Peer, *payloads: AnyPayload, **kwargs) -> None:
+    def _peer_address(self, peer: Peer):
         addr = peer.addresses.get(UDPv4LANAddress, None)
         if addr is None:
             addr = peer.addresses.get(UDPv4Address, None)
         assert addr is not None
+        return addr
+
+    def ez_send(self, peer: Peer, *payloads: AnyPayload, **kwargs) -> None:
+        addr = self._peer_address(peer)
         self._message_history.add_message(*payloads, destination=addr)
         self._ez_senda(addr, *payloads, **kwargs)
 
+    def ez_pack(self, *payloads: AnyPayload, **kwargs) -> bytes:
+        """Serialize (and sign) payloads once, so the packet can be sent to several peers with ez_send_packed"""
+        return self.ezr_pack(payloads[-1].msg_id, *payloads, **kwargs)
+
+    def ez_send_packed(self, peer: Peer, packet: bytes, *payloads: AnyPayload) -> None:
+        """Send a packet created by ez_pack for the given payloads"""
+        addr = self._peer_address(peer)
+        self._message_history.add_message(*payloads, destination=addr)
+        self.endpoint.send(addr, packet)
+
     def add_message_handler(self, msg_num: int | type[AnyPayload], callback: MessageHandlerFunction) -> None:
         super().add_message_handler(msg_num, callback)
 
@@ -0,0 +1,102 @@
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:  # numba is optional, without it the search runs in plain Python
+    njit = None
+
+
+def _count_disjoint_masks(masks, limit):
+    """
+    Largest number of pairwise disjoint masks (up to limit), by a depth-first branch and bound search
+
+    Written with an explicit stack of integers and a dict memo only, so that numba can compile it.
+    """
+    n = len(masks)
+    best = 0
+    # next_mask[d] is the next mask to try at depth d, used[d] the union of the d masks chosen so far
+    next_mask = [0] * (n + 1)
+    used = [0] * (n + 1)
+    # Most masks chosen when reaching (next mask, union): the search from there only depends on those two
+    reached = dict()
+    depth = 0
+    while depth >= 0:
+        if depth > best:
+            best = depth
+            if best >= limit:
+                break
+        j = next_mask[depth]
+        if j >= n or depth + n - j <= best:
+            depth -= 1
+            continue
+        next_mask[depth] = j + 1
+        if masks[j] & used[depth] == 0:
+            union = used[depth] | masks[j]
+            # Skip subproblems already searched with at least as many masks chosen
+            if reached.get((j + 1, union), -1) < depth + 1:
+                reached[(j + 1, union)] = depth + 1
+                used[depth + 1] = union
+                next_mask[depth + 1] = j + 1
+                depth += 1
+    return min(best, limit)
+
+
+_count_disjoint_masks_jit = njit(cache=True)(_count_disjoint_masks) if njit is not None else None
+
+
+def count_disjoint_masks(masks, limit):
+    """
+    Number of pairwise disjoint masks (node sets encoded as bits), up to limit
+
+    Runs compiled when numba is installed and every mask fits in an int64.
+    """
+    if _count_disjoint_masks_jit is not None and masks and max(masks) < 1 << 63:
+        return int(_count_disjoint_masks_jit(np.array(masks, dtype=np.int64), limit))
+    return _count_disjoint_masks(masks, limit)
+
+
+def first_hop_insert(buckets, path):
+    """
+    Insert a path into a dict mapping the first hop after the source to the paths kept through it,
+    returns False if the kept paths did not change
+
+    Paths through the same first hop are never disjoint, and a path through all nodes of another
+    path in its bucket can always be swapped for that one, so only paths that contain no other
+    path of their bucket are kept. This leaves the number of disjoint paths unchanged.
+    """
+    mask = 0
+    for node in path[1:]:
+        mask |= 1 << node
+    # A direct path has no first hop to share with others
+    bucket = buckets.setdefault(path[1] if len(path) > 1 else path, {})
+    for kept in bucket:
+        if kept & mask == kept:
+            return False
+    for kept in [kept for kept in bucket if kept & mask == mask]:
+        del bucket[kept]
+    bucket[mask] = path
+    return True
+
+
+def kept_paths(buckets):
+    """All paths kept by first_hop_insert"""
+    for bucket in buckets.values():
+        yield from bucket.values()
+
+
+def count_disjoint_paths(paths, limit=None):
+    """
+    Number of pairwise disjoint paths (ignoring the first node of each path), up to limit
+
+    This is a maximum set packing, for which no polynomial algorithm is known, so the search is
+    exhaustive (see count_disjoint_masks). It stops as soon as limit disjoint paths are found and
+    skips branches that cannot beat the best count so far.
+    """
+    masks = []
+    for path in paths:
+        mask = 0
+        for node in path[1:]:
+            mask |= 1 << node
+        masks.append(mask)
+    # Paths through fewer nodes first: they conflict less, so large sets are found early
+    masks.sort(key=lambda mask: bin(mask).count("1"))
+    return count_disjoint_masks(masks, len(masks) if limit is None else limit)
@@ -0,0 +1,38 @@
+import hashlib
+import os
+
+
+class SaltedCache:
+    """
+    Set of recently seen byte strings, stored as salted BLAKE2b digests.
+
+    rotate() starts a new generation with a fresh random salt and drops the oldest generation,
+    so entries are remembered for one to two rotation periods and memory stays bounded.
+    The random salt keeps peers from crafting colliding entries.
+    """
+    def __init__(self, digest_size: int = 16):
+        self.__digest_size = digest_size
+        self.__salt = os.urandom(16)
+        self.__previous_salt = self.__salt
+        self.__current = set()
+        self.__previous = set()
+
+    def __digest(self, data: bytes, salt: bytes) -> bytes:
+        return hashlib.blake2b(data, key=salt, digest_size=self.__digest_size).digest()
+
+    def check_and_put(self, data: bytes) -> bool:
+        """Add data to the cache, returns True if it was already in it"""
+        digest = self.__digest(data, self.__salt)
+        if digest in self.__current:
+            return True
+        if self.__previous and self.__digest(data, self.__previous_salt) in self.__previous:
+            return True
+        self.__current.add(digest)
+        return False
+
+    def rotate(self):
+        self.__previous, self.__previous_salt = self.__current, self.__salt
+        self.__current, self.__salt = set(), os.urandom(16)
+
+    def __len__(self):
+        return len(self.__current) + len(self.__previous)
@@ -0,0 +1,68 @@
+import asyncio
+import itertools
+import os
+
+import numpy as np
+from ipv8.types import Peer
+
+
+class DelayedSends:
+    """
+    Mixin for a DistributedAlgorithm that sends every message after a random delay
+
+    The delays are drawn between the min_message_delay and max_message_delay of the algorithm.
+    Delayed sends are done by a fixed pool of SEND_WORKERS workers, which take the send that is
+    due first. Override send_now to change what is done with a send once it is due.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.send_queue = asyncio.PriorityQueue()
+        self.send_seq = itertools.count()  # Tie-breaker, so queue entries never compare peers
+        self.rng = np.random.default_rng()
+        for i in range(int(os.getenv('SEND_WORKERS', '10'))):
+            self.register_task(f"send_worker_{i}", self.send_worker)
+
+    def enqueue_sends(self, peers, payload) -> None:
+        # Draw the delays of all peers in one vectorized call
+        now = asyncio.get_event_loop().time()
+        delays = self.rng.uniform(self.min_message_delay, self.max_message_delay, len(peers)).tolist()
+        for peer, delay in zip(peers, delays):
+            self.send_queue.put_nowait((now + delay, next(self.send_seq), peer, payload))
+
+    async def send_worker(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            due, _, peer, payload = await self.send_queue.get()
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                self.send_now(peer, payload)
+            except Exception as e:
+                print(f"Error in send_worker: {e}")
+
+    def send_now(self, peer: Peer, payload) -> None:
+        self.ez_send(peer, payload)
+
+
+class PeerSnapshot:
+    """Mixin for a DistributedAlgorithm that looks up the node id of its peers in a cached snapshot"""
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # (peer, node_id) of all neighbors and node_id per peer, rebuilt when the set of known nodes changes
+        self.peers_snapshot = []
+        self.peer_ids = {}
+        self.snapshot_num_nodes = -1
+
+    def get_peers_snapshot(self):
+        if len(self.nodes) != self.snapshot_num_nodes:
+            self.peer_ids = {peer: node_id for node_id, peer in self.nodes.items()}
+            self.peers_snapshot = [(peer, self.peer_ids[peer]) for peer in self.get_peers() if peer in self.peer_ids]
+            self.snapshot_num_nodes = len(self.nodes)
+        return self.peers_snapshot
+
+    def peer_id(self, peer: Peer) -> int:
+        self.get_peers_snapshot()
+        node_id = self.peer_ids.get(peer)
+        return node_id if node_id is not None else self.node_id_from_peer(peer)
+
@@ -1,4 +1,4 @@
-import copy
+import json
 from pathlib import Path
 from typing import Optional
 
@@ -6,6 +6,8 @@ import click
 import yaml
 import networkx as nx
 
+# libyaml's loader when PyYAML was built with it, it parses the same documents as the pure Python one
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 
 @click.group()
@@ -25,6 +27,7 @@ def cli():
 @click.option('--max_message_delay', type=float, default=0.1)
 @click.option('--broadcasters', type=int, default=1)
 @click.option('--broadcasts', type=int, default=1)
+@click.option('--batch_size', type=int, default=1, help='Number of RCO broadcasts of a node that share one Bracha broadcast')
 @click.option('--connectivity', type=int, default=3, help='Degree of each node in the random graph')
 @click.option('--debug_mode', type=int, default=1, help='Debug mode: 0=silent, 1=deliveries only, 2=all logs')
 @click.option('--debug_algorithm', type=str, default='all', help='Debug algorithm filter: "all", "dolev", "bracha", etc.')
@@ -33,10 +36,10 @@ def cli():
 @click.option('--opt_reduced_messages', is_flag=True, help='Enable reduced number of messages optimization (MBD.11)')
 @click.option('--template_file', type=str,  default='docker-compose.template.yml')
 @click.option('--overwrite_topology',is_flag=True, help='Overwrite the topology file. Useful for topologies that can be adjusted dynamically such as rings. Do not use this option if you have a static topology file that you want the preserve!')
-def compose(num_nodes, topology_file, algorithm, faults, num_byzantine, limited_neighbors, byzantine_behavior, min_message_delay, max_message_delay, broadcasters, broadcasts, connectivity, debug_mode, debug_algorithm, opt_echo_amplification, opt_single_hop_send, opt_reduced_messages, template_file, overwrite_topology):
-    prepare_compose_file(num_nodes, topology_file, algorithm, faults, num_byzantine, limited_neighbors, byzantine_behavior, min_message_delay, max_message_delay, broadcasters, broadcasts, connectivity, debug_mode, debug_algorithm, opt_echo_amplification, opt_single_hop_send, opt_reduced_messages, template_file, overwrite_topology=overwrite_topology)
+def compose(num_nodes, topology_file, algorithm, faults, num_byzantine, limited_neighbors, byzantine_behavior, min_message_delay, max_message_delay, broadcasters, broadcasts, batch_size, connectivity, debug_mode, debug_algorithm, opt_echo_amplification, opt_single_hop_send, opt_reduced_messages, template_file, overwrite_topology):
+    prepare_compose_file(num_nodes, topology_file, algorithm, faults, num_byzantine, limited_neighbors, byzantine_behavior, min_message_delay, max_message_delay, broadcasters, broadcasts, batch_size, connectivity, debug_mode, debug_algorithm, opt_echo_amplification, opt_single_hop_send, opt_reduced_messages, template_file, overwrite_topology=overwrite_topology)
 
-def prepare_compose_file(num_nodes, topology_file, algorithm, faults, num_byzantine, limited_neighbors, byzantine_behavior, min_message_delay, max_message_delay, broadcasters, broadcasts, connectivity, debug_mode, debug_algorithm, opt_echo_amplification, opt_single_hop_send, opt_reduced_messages, template_file, location='cs4545', overwrite_topology = False):
+def prepare_compose_file(num_nodes, topology_file, algorithm, faults, num_byzantine, limited_neighbors, byzantine_behavior, min_message_delay, max_message_delay, broadcasters, broadcasts, batch_size, connectivity, debug_mode, debug_algorithm, opt_echo_amplification, opt_single_hop_send, opt_reduced_messages, template_file, location='cs4545', overwrite_topology = False):
     import random
 
     G = nx.random_regular_graph(connectivity, num_nodes)
@@ -44,7 +47,10 @@ def prepare_compose_file(num_nodes, topology_file, algorithm, faults, num_byzant
     with open(template_file, 'r') as f:
         content = yaml.safe_load(f)
 
+        # The template node is plain YAML data, so a JSON round trip copies it faster than deepcopy.
+        # Its environment is built per node from env_template below instead
         node = content['services']['node0']
+        node_template = json.dumps({key: value for key, value in node.items() if key != 'environment'})
         content['x-common-variables']['TOPOLOGY'] = topology_file
 
         nodes = {}
@@ -56,26 +62,32 @@ def prepare_compose_file(num_nodes, topology_file, algorithm, faults, num_byzant
         network_base = '.'.join(subnet.split('/')[0].split('.')[:-1])
 
         # Randomly select broadcaster nodes
-        broadcaster_nodes = random.sample(range(num_nodes), min(broadcasters, num_nodes))
-        byzantine_nodes = random.sample(range(num_nodes), min(num_byzantine, num_nodes))
+        broadcaster_nodes = set(random.sample(range(num_nodes), min(broadcasters, num_nodes)))
+        byzantine_nodes = set(random.sample(range(num_nodes), min(num_byzantine, num_nodes)))
+
+        # Environment variables that are the same for every node
+        env_template = {
+            **node['environment'],
+            'NUM_NODES': num_nodes,
+            'TOPOLOGY': topology_file,
+            'ALGORITHM': algorithm,
+            'LOCATION': location,
+            'FAULTS': faults,
+            'MIN_MESSAGE_DELAY': min_message_delay,
+            'MAX_MESSAGE_DELAY': max_message_delay,
+            'DEBUG_MODE': debug_mode,
+            'DEBUG_ALGORITHM': debug_algorithm,
+            'OPT_ECHO_AMPLIFICATION': 'true' if opt_echo_amplification else 'false',
+            'OPT_SINGLE_HOP_SEND': 'true' if opt_single_hop_send else 'false',
+            'OPT_REDUCED_MESSAGES': 'true' if opt_reduced_messages else 'false',
+            'RCO_BATCH_SIZE': batch_size,
+        }
 
         for i in range(num_nodes):
-            n = copy.deepcopy(node)
+            n = json.loads(node_template)
             n['ports'] = [f'{baseport + i}:{baseport + i}']
             n['networks'][network_name]['ipv4_address'] = f'{network_base}.{10 + i}'
-            n['environment']['NUM_NODES'] = num_nodes
-            n['environment']['PID'] = i
-            n['environment']['TOPOLOGY'] = topology_file
-            n['environment']['ALGORITHM'] = algorithm
-            n['environment']['LOCATION'] = location
-            n['environment']['FAULTS'] = faults
-            n['environment']['MIN_MESSAGE_DELAY'] = min_message_delay
-            n['environment']['MAX_MESSAGE_DELAY'] = max_message_delay
-            n['environment']['DEBUG_MODE'] = debug_mode
-            n['environment']['DEBUG_ALGORITHM'] = debug_algorithm
-            n['environment']['OPT_ECHO_AMPLIFICATION'] = 'true' if opt_echo_amplification else 'false'
-            n['environment']['OPT_SINGLE_HOP_SEND'] = 'true' if opt_single_hop_send else 'false'
-            n['environment']['OPT_REDUCED_MESSAGES'] = 'true' if opt_reduced_messages else 'false'
+            n['environment'] = {**env_template, 'PID': i}
 
             if i in byzantine_nodes:
                 n['environment']['BYZANTINE_BEHAVIOR'] = byzantine_behavior
@@ -97,7 +109,7 @@ def prepare_compose_file(num_nodes, topology_file, algorithm, faults, num_byzant
             # connections[i] = [(i + 1) % num_nodes, (i - 1) % num_nodes]
 
             # # Random graph
-            connections[i] = [a for (a,b) in G.edges if b==i] + [b for (a,b) in G.edges if a==i]
+            connections[i] = list(G.adj[i])
 
         content['services'] = nodes
 
@@ -146,7 +158,10 @@ def eval(cfg_file: str, output_dir: str, verbose: bool = True, append_file: Opti
     valid = 0
     invalid = 0
 
-    node_stats = [yaml.safe_load(open(x)) for x in out_dir.iterdir() if x.suffix == '.yml']
+    node_stats = []
+    for x in [x for x in out_dir.iterdir() if x.suffix == '.yml']:
+        with open(x, 'r') as f2:
+            node_stats.append(yaml.load(f2, Loader=SafeLoader))
 
     # Aggregate the node stats where the structure is a list of dictionaries with the same keys
     agg_stats = {}
@@ -1,8 +1,23 @@
 #!/usr/bin/env python3
+import os
 import re
 import sys
+import mmap
 from collections import defaultdict
 
+# Compiled once and run over the whole mapped log file, so lines that do not match never become Python objects
+BROADCAST_RE = re.compile(rb'node(\d+)-1.*\[RCO-BROADCAST\] Node (\d+): Broadcasting message \[(\d+): "([^"\n]+)"\]')
+DELIVER_RE = re.compile(rb'node(\d+)-1.*\[RCO-DELIVER\] Node (\d+): Delivered message from sender (\d+): "([^"\n]+)".*VC=(\[.*?\])')
+
+def find_lines(buf, pattern):
+    """Yield (line number, match) for every line of buf matched by pattern, in file order"""
+    line_num, pos = 1, 0
+    for match in pattern.finditer(buf):
+        # mmap has no count, slicing copies each stretch between matches once
+        line_num += buf[pos:match.start()].count(b'\n')
+        pos = match.start()
+        yield line_num, match
+
 def analyze_logs(log_file):
     # Track broadcasts (sender_id, message, broadcast_time)
     broadcasts = []
@@ -11,17 +26,16 @@ def analyze_logs(log_file):
     node_deliveries = defaultdict(list)
 
     try:
-        with open(log_file, 'r') as f:
-            for line_num, line in enumerate(f, 1):
+        with open(log_file, 'rb') as f:
+            # An empty file cannot be mapped, and has nothing to analyze
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
                 # Match RCO-BROADCAST lines
-                broadcast_match = re.search(
-                    r'node(\d+)-1.*\[RCO-BROADCAST\] Node (\d+): Broadcasting message \[(\d+): "([^"]+)"\]',
-                    line
-                )
-                if broadcast_match:
+                for line_num, broadcast_match in find_lines(buf, BROADCAST_RE):
                     node_id = int(broadcast_match.group(2))
                     sender_id = int(broadcast_match.group(3))
-                    message = broadcast_match.group(4)
+                    message = broadcast_match.group(4).decode()
                     broadcasts.append({
                         'sender': sender_id,
                         'message': message,
@@ -30,15 +44,11 @@ def analyze_logs(log_file):
                     })
 
                 # Match RCO-DELIVER lines
-                deliver_match = re.search(
-                    r'node(\d+)-1.*\[RCO-DELIVER\] Node (\d+): Delivered message from sender (\d+): "([^"]+)".*VC=(\[.*?\])',
-                    line
-                )
-                if deliver_match:
+                for line_num, deliver_match in find_lines(buf, DELIVER_RE):
                     node_id = int(deliver_match.group(2))
                     sender_id = int(deliver_match.group(3))
-                    message = deliver_match.group(4)
-                    vector_clock = deliver_match.group(5)
+                    message = deliver_match.group(4).decode()
+                    vector_clock = deliver_match.group(5).decode()
 
                     node_deliveries[node_id].append({
                         'sender': sender_id,
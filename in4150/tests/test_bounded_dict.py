@@ -0,0 +1,68 @@
+"""
+Run from the in4150 directory with: python -m unittest tests/test_bounded_dict.py
+"""
+import unittest
+from unittest import mock
+
+from cs4545.system.bounded_dict import BoundedDict, BoundedSet
+
+
+class TestBoundedDict(unittest.TestCase):
+    def test_evict_by_capacity(self):
+        evicted = []
+        bounded = BoundedDict(2, on_evict=lambda key, value: evicted.append((key, value)))
+        for i in range(5):
+            bounded[i] = str(i)
+
+        self.assertEqual([(3, '3'), (4, '4')], list(bounded.items()))
+        self.assertEqual([(0, '0'), (1, '1'), (2, '2')], evicted)
+
+    def test_evict_least_recently_written(self):
+        bounded = BoundedDict(2)
+        bounded['a'] = 1
+        bounded['b'] = 2
+        bounded.setdefault('a', 0)
+        bounded['c'] = 3
+
+        self.assertEqual(['a', 'c'], list(bounded))
+
+    def test_evict_by_ttl(self):
+        evicted = []
+        bounded = BoundedDict(10, ttl=5, on_evict=lambda key, value: evicted.append(key))
+        with mock.patch('time.monotonic', return_value=100):
+            bounded['old'] = 1
+        with mock.patch('time.monotonic', return_value=103):
+            bounded['new'] = 2
+        with mock.patch('time.monotonic', return_value=106):
+            bounded['newest'] = 3
+
+        self.assertEqual(['new', 'newest'], list(bounded))
+        self.assertEqual(['old'], evicted)
+
+    def test_remove(self):
+        evicted = []
+        bounded = BoundedDict(2, on_evict=lambda key, value: evicted.append(key))
+        bounded['a'] = 1
+        bounded['b'] = 2
+        self.assertEqual(1, bounded.pop('a'))
+        self.assertIsNone(bounded.pop('a', None))
+        del bounded['b']
+        bounded['c'] = 3
+        bounded['d'] = 4
+        bounded['e'] = 5
+
+        # Removed entries are not evicted again, and do not count towards the capacity
+        self.assertEqual(['d', 'e'], list(bounded))
+        self.assertEqual(['c'], evicted)
+
+    def test_bounded_set(self):
+        bounded = BoundedSet(2)
+        for i in range(3):
+            bounded.add(i)
+
+        self.assertNotIn(0, bounded)
+        self.assertIn(2, bounded)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+"""
+In-process simulation of the broadcast algorithms, on ipv8's mocked network instead of docker
+
+Run from the in4150 directory with: python -m unittest tests/test_simulation.py
+"""
+import io
+import os
+import re
+from contextlib import redirect_stdout
+from unittest import mock
+
+from ipv8.test.base import TestBase
+
+from cs4545.implementation import DolevAlgorithm, BrachaAlgorithm, RCOAlgorithm
+from cs4545.implementation.old import dolev_algorithm_old, bracha_algorithm_old, bracha_algorithm_old2
+
+
+class TestSimulation(TestBase):
+    NUM_NODES = 4
+
+    def start_nodes(self, algorithm, **env) -> None:
+        """Create a fully connected network of NUM_NODES nodes running algorithm, with env as their environment"""
+        environment = {
+            'NUM_NODES': str(self.NUM_NODES),
+            'FAULTS': '1',
+            'MIN_MESSAGE_DELAY': '0',
+            'MAX_MESSAGE_DELAY': '0',
+            'NUM_BROADCASTS': '1',
+            'DEBUG_MODE': '0',
+            **env,
+        }
+        # The algorithms read their configuration from the environment when they are created
+        with mock.patch.dict(os.environ, environment):
+            self.initialize(algorithm, self.NUM_NODES)
+
+        # What DistributedAlgorithm.started and the connection messages set up in a real run
+        for node_id, node in enumerate(self.nodes):
+            node.overlay.node_id = node_id
+            node.overlay.starting_node = -1
+            for other_id, other in enumerate(self.nodes):
+                if other_id != node_id:
+                    node.overlay.nodes[other_id] = node.overlay.network.get_verified_by_public_key_bin(
+                        other.my_peer.public_key.key_to_bin())
+
+    async def run_nodes(self) -> None:
+        for node in self.nodes:
+            await node.overlay.on_start()
+        await self.deliver_messages(timeout=2)
+
+    async def test_dolev(self):
+        self.start_nodes(DolevAlgorithm)
+        await self.run_nodes()
+
+        for node in self.nodes:
+            for sender_id in range(self.NUM_NODES):
+                msg_key = node.overlay._key_id(sender_id, b'DMessage-0')
+                self.assertTrue(node.overlay._has_flag(msg_key, DolevAlgorithm.F_DELIVERED_DOLEV))
+
+    async def test_dolev_delayed(self):
+        self.start_nodes(DolevAlgorithm, MIN_MESSAGE_DELAY='0.001', MAX_MESSAGE_DELAY='0.005')
+        await self.run_nodes()
+
+        for node in self.nodes:
+            for sender_id in range(self.NUM_NODES):
+                msg_key = node.overlay._key_id(sender_id, b'DMessage-0')
+                self.assertTrue(node.overlay._has_flag(msg_key, DolevAlgorithm.F_DELIVERED_DOLEV))
+
+    async def test_dolev_evicted_state(self):
+        self.start_nodes(DolevAlgorithm, NUM_BROADCASTS='3', STATE_CACHE_SIZE='1')
+        deliveries = []
+
+        async def rc_deliver(overlay, sender_id, content):
+            deliveries.append((overlay.node_id, sender_id, content))
+
+        with mock.patch.object(DolevAlgorithm, 'rc_deliver', rc_deliver):
+            await self.run_nodes()
+
+        # Late copies of evicted messages are not delivered again
+        self.assertEqual(3 * self.NUM_NODES * self.NUM_NODES, len(deliveries))
+        self.assertEqual(len(set(deliveries)), len(deliveries))
+        for node in self.nodes:
+            for sender_id in range(self.NUM_NODES):
+                for i in range(3):
+                    msg_key = node.overlay._key_id(sender_id, f'DMessage-{i}'.encode())
+                    self.assertTrue(node.overlay._has_flag(msg_key, DolevAlgorithm.F_DELIVERED_DOLEV))
+            # Only the content of the last completed message (and of messages still in progress) is kept
+            self.assertTrue(node.overlay._retired_keys)
+            self.assertLess(len(node.overlay._keycache), 3 * self.NUM_NODES)
+
+    async def test_dolev_retired_keys_evicted(self):
+        self.start_nodes(DolevAlgorithm, NUM_BROADCASTS='0', STATE_CACHE_SIZE='1', RETIRED_KEY_CAPACITY='2')
+        overlay = self.overlay(0)
+        msg_keys = [overlay._key_id(1, f'DMessage-{i}'.encode()) for i in range(5)]
+        for msg_key in msg_keys:
+            overlay._set_flag(msg_key, DolevAlgorithm.F_DELIVERED_DOLEV)
+            overlay._mark_completed(msg_key)
+
+        # The oldest retired keys are dropped together with their flags, the newest ones are still found
+        self.assertEqual(2, len(overlay._retired_keys))
+        self.assertEqual(set(msg_keys[-3:]), set(overlay._flags))
+        self.assertEqual(msg_keys[-2], overlay._key_id(1, b'DMessage-3'))
+        self.assertNotIn(overlay._key_id(1, b'DMessage-0'), msg_keys)
+
+    async def test_bracha(self):
+        self.start_nodes(BrachaAlgorithm)
+        await self.run_nodes()
+
+        for node in self.nodes:
+            for sender_id in range(self.NUM_NODES):
+                msg_key = node.overlay._key_id(sender_id, 'Message-0')
+                self.assertTrue(node.overlay._has_flag(msg_key, BrachaAlgorithm.F_DELIVERED_BRACHA))
+
+    async def test_dolev_old(self):
+        self.start_nodes(dolev_algorithm_old.DolevAlgorithm, MIN_MESSAGE_DELAY='0.001', MAX_MESSAGE_DELAY='0.005')
+        await self.run_nodes()
+
+        for node in self.nodes:
+            for sender_id in range(self.NUM_NODES):
+                key = (f'Message 0 from node {sender_id}', sender_id)
+                self.assertIn(node.overlay.node_id, node.overlay.delivered[key])
+
+    async def test_bracha_old(self):
+        self.start_nodes(bracha_algorithm_old.BrachaAlgorithm, MIN_MESSAGE_DELAY='0.001', MAX_MESSAGE_DELAY='0.005')
+        await self.run_nodes()
+
+        for node in self.nodes:
+            for sender_id in range(self.NUM_NODES):
+                self.assertTrue(node.overlay.bracha[(sender_id, f'Message 0 from node {sender_id}')].delivered)
+
+    async def test_bracha_old2(self):
+        self.start_nodes(bracha_algorithm_old2.BrachaAlgorithm, MIN_MESSAGE_DELAY='0.001', MAX_MESSAGE_DELAY='0.005')
+        await self.run_nodes()
+
+        for node in self.nodes:
+            for sender_id in range(self.NUM_NODES):
+                self.assertTrue(node.overlay.bracha[(f'Message 0 from node {sender_id}', sender_id)].delivered)
+
+    async def test_rco(self):
+        self.start_nodes(RCOAlgorithm, NUM_BROADCASTS='2')
+        await self.run_nodes()
+        self.check_rco_delivered(2)
+
+    async def test_rco_bracha_completed(self):
+        self.start_nodes(RCOAlgorithm, NUM_BROADCASTS='2')
+        deliveries = []
+        brb_deliver = RCOAlgorithm.brb_deliver
+
+        async def counting_brb_deliver(overlay, msg):
+            deliveries.append((overlay.node_id, msg.sender_id, msg.content))
+            self.assertTrue(overlay._has_flag(overlay._key_id(msg.sender_id, msg.content), RCOAlgorithm.F_DELIVERED_BRACHA))
+            await brb_deliver(overlay, msg)
+
+        with mock.patch.object(RCOAlgorithm, 'brb_deliver', counting_brb_deliver):
+            await self.run_nodes()
+        self.check_rco_delivered(2)
+
+        # Every RCO broadcast is Bracha-delivered once, and its Bracha state is marked completed
+        self.assertEqual(len(set(deliveries)), len(deliveries))
+        for node_id, sender_id, content in deliveries:
+            overlay = self.overlay(node_id)
+            self.assertIn(overlay._key_id(sender_id, content), overlay._completed)
+
+    async def test_rco_unpacked_vector_clocks(self):
+        # Vector clocks are only packed into ints for small networks, use numpy ones like a large network does
+        with mock.patch('cs4545.implementation.rco_algorithm.PACKED_VC_MAX_NODES', 0):
+            self.start_nodes(RCOAlgorithm, NUM_BROADCASTS='2')
+        self.assertIsNone(self.overlay(0)._vc_packed)
+        await self.run_nodes()
+        self.check_rco_delivered(2)
+
+    async def test_rco_colluding_node(self):
+        # A colluding node checks the (bytes) content of the RCO messages for forgeries
+        self.start_nodes(RCOAlgorithm)
+        self.overlay(3).byzantine_behavior = 'collude'
+        await self.run_nodes()
+
+        # It still broadcasts its own messages, which the correct nodes deliver as usual
+        for node in self.nodes[:3]:
+            self.assertEqual({(sender_id, 'Message-0') for sender_id in range(self.NUM_NODES)
+                              if sender_id != node.overlay.node_id},
+                             node.overlay.rco_delivered)
+
+    async def test_rco_deliver_log(self):
+        # tests/a3/analyze_order.py reads the VC of every delivery from this log line, as a list
+        self.start_nodes(RCOAlgorithm, DEBUG_MODE='1', DEBUG_ALGORITHM='rco')
+        output = io.StringIO()
+        with redirect_stdout(output):
+            await self.run_nodes()
+
+        deliveries = re.findall(r'\[RCO-DELIVER\] Node \d+: Delivered message from sender \d+: "[^"]+" \| VC=(.*)',
+                                output.getvalue())
+        self.assertEqual(self.NUM_NODES * self.NUM_NODES, len(deliveries))
+        for vector_clock in deliveries:
+            self.assertRegex(vector_clock, r'^\[\d+(, \d+)*\]$')
+
+    def check_rco_delivered(self, num_broadcasts) -> None:
+        """Every node delivered all broadcasts of the others, and has nothing left pending"""
+        for node in self.nodes:
+            others = {(sender_id, f'Message-{i}') for sender_id in range(self.NUM_NODES) for i in range(num_broadcasts)
+                      if sender_id != node.overlay.node_id}
+            self.assertEqual(others, node.overlay.rco_delivered)
+            self.assertEqual([num_broadcasts] * self.NUM_NODES, node.overlay.vector_clock.tolist())
+            self.assertFalse(node.overlay.pending)